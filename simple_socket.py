@@ -1,9 +1,34 @@
+import asyncio
 import socket
+import struct
 
 ####### https://docs.python.org/3/library/socket.html#socket.socket.sendfile #######
 # socket.gethostbyname(str(socket.gethostname()))#
 
-HEADER, FORMAT = 64, "utf-8"
+# Messages are bytes, framed by their length.
+HEADER = struct.Struct("!I")
+
+
+def frame(message):
+    return HEADER.pack(len(message)) + message
+
+
+def recv_exactly(conn, size):
+    chunks = []
+    while size > 0:
+        data = conn.recv(size)
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+
+def recv_message(conn):
+    header = recv_exactly(conn, HEADER.size)
+    if header is None:
+        return b""
+    return recv_exactly(conn, HEADER.unpack(header)[0]) or b""
 
 
 class Client:
@@ -18,73 +43,34 @@ class Client:
         self.client.connect(ADDR)
 
     def send(self, msg):
-        message = msg.encode(FORMAT)
-        msg_length = len(message)
-        send_length = str(msg_length).encode(FORMAT)
-        send_length += b" " * (HEADER - len(send_length))
-        self.client.sendall(send_length)
-        self.client.sendall(message)
+        self.client.sendall(frame(msg))
 
     def rcv(self):
-        msg_length = self.client.recv(HEADER).decode(FORMAT)
-        total_received = 0
-        if msg_length:
-            msg = []
-            while total_received < int(msg_length):
-                data = self.client.recv(int(msg_length))
-                total_received += len(data)
-                msg.append(data)
-            return b"".join(msg).decode(FORMAT)
-        return ""
+        return recv_message(self.client)
 
     def close(self):
         self.client.close()
 
 
-class Server:
-    def __init__(self, ip, port):
-        self.ip = ip
-        self.port = port
-
-    def start(self):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        ADDR = (self.ip, self.port)
-        self.server.bind(ADDR)
-        self.conns = []
-
-    def lsn(self, conns=0):
-        if conns > 0:
-            self.server.listen(conns)
-        else:
-            self.server.listen()
-
-    def accept(self):
-        conn, addr = self.server.accept()
-        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.conns.append(conn)
-        return conn, addr
-
-    def send(self, conns, msg):
-        message = msg.encode(FORMAT)
-        msg_length = len(message)
-        send_length = str(msg_length).encode(FORMAT)
-        send_length += b" " * (HEADER - len(send_length))
-        for conn in conns:
-            conn.sendall(send_length)
-            conn.sendall(message)
-
-    def rcv(self, conn):
-        msg_length = conn.recv(HEADER).decode(FORMAT)
-        total_received = 0
-        if msg_length:
-            msg = []
-            while total_received < int(msg_length):
-                data = conn.recv(int(msg_length))
-                total_received += len(data)
-                msg.append(data)
-            return b"".join(msg).decode(FORMAT)
-        return ""
-
-    def close(self, conn):
-        conn.close()
-        self.conns.remove(conn)
+class AsyncConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, msg):
+        self.writer.write(frame(msg))
+        await self.writer.drain()
+
+    async def rcv(self):
+        try:
+            (msg_length,) = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+            return await self.reader.readexactly(msg_length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return b""
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
@@ -1,10 +1,13 @@
 #! /usr/bin/env python
 
-from time import time
+from statistics import median
+from time import perf_counter, time
 
-from constants import PLAYERS
+import numpy as np
+
+from constants import PLAYERS, WORLD_X, WORLD_Y
 from tests.marching_squares_test import DeterministicEnvironment
-from wod_server import Environment, Game, Troop
+from wod_server import Environment, Game
 
 
 class BenchmarkGame(Game):
@@ -20,19 +23,16 @@ class BenchmarkGame(Game):
             if self.player_inputs[p_num]:
                 paths_to_apply.extend(self.player_inputs[p_num])
         self.player_inputs = [[] for i in range(PLAYERS)]
-        self.ready = False
         assert len(paths_to_apply) == 0
         self.environment.update_troops(paths_to_apply)
-        self.ready = True
 
 
 def add_troops(env: Environment, num_troops: int = 40) -> Environment:
     for i, city in enumerate(env.cities):  # We assume 2 cities and 2 players.
         x, y = city.position
         assert 4 == len(env.draw_info(player=i))
-        player = env.players[i]
         for _ in range(num_troops):
-            player.troops.append(Troop((x + 4 * i, y + i), player))
+            env.add_troop((x + 4 * i, y + i), i)
 
     return env
 
@@ -48,5 +48,32 @@ def bench(num_update_cycles: int = 1_000) -> None:
     print(f"{elapsed=} seconds")
 
 
+def add_spread_troops(env: Environment, num_troops: int = 2_000) -> Environment:
+    # Troops all over the map with alternating owners; two in three head somewhere else.
+    rng = np.random.default_rng(0)
+    size = np.array([WORLD_X - 40, WORLD_Y - 40])
+    for i in range(num_troops):
+        x, y = rng.random(2) * size + 20
+        path = [(rng.random(2) * size + 20).tolist()] if i % 3 else []
+        env.add_troop((float(x), float(y)), i % 2, path)
+
+    return env
+
+
+def bench_tick(num_troops: int = 2_000, num_ticks: int = 200, tick_rate: int = 45) -> None:
+    game = BenchmarkGame()
+    game.environment = add_spread_troops(DeterministicEnvironment(), num_troops)
+
+    ticks = []
+    for _ in range(num_ticks):
+        t0 = perf_counter()
+        game.game_logic()
+        ticks.append(perf_counter() - t0)
+    tick_ms = round(1000 * median(ticks), 1)
+    budget_ms = round(1000 / tick_rate, 1)
+    print(f"{num_troops=} {tick_ms=} {budget_ms=}")
+
+
 if __name__ == "__main__":
     bench()
+    bench_tick()
@@ -0,0 +1,443 @@
+import socket
+import time
+import unittest
+
+import numpy as np
+import pygame
+
+import simple_socket
+import wire
+from constants import CELL_SIZE, COLS, ROWS, TABLE, THRESHOLD, WORLD_X, WORLD_Y
+from tests.marching_squares_test import DeterministicEnvironment
+from wod_client import (
+    ContourCache,
+    Game,
+    Interpolator,
+    Overlay,
+    RasterFog,
+    Receiver,
+    SpatialIndex,
+    SpriteCache,
+    TerrainTiles,
+    draw_flag,
+    draw_troop,
+    fog_alpha,
+    marching_squares,
+    marching_squares_poly,
+)
+
+
+def reference_interp(threshold, a, b):
+    if a == b:
+        return 0.5
+    t = (threshold - a) / (b - a)
+    return max(0.0, min(1.0, t))
+
+
+def reference_marching_squares(grid, cs, rows, cols, threshold):
+    """The original per-cell border segment loop."""
+    point_pairs = {
+        1: [(3, 0)],
+        2: [(0, 1)],
+        3: [(3, 1)],
+        4: [(1, 2)],
+        5: [(3, 0), (1, 2)],
+        6: [(0, 2)],
+        7: [(3, 2)],
+        8: [(2, 3)],
+        9: [(0, 2)],
+        10: [(0, 1), (2, 3)],
+        11: [(1, 2)],
+        12: [(1, 3)],
+        13: [(0, 1)],
+        14: [(3, 0)],
+    }
+    segments = []
+    for j in range(rows):
+        for i in range(cols):
+            c0 = grid[j][i]
+            c3 = grid[j][i + 1]
+            c2 = grid[j + 1][i + 1]
+            c1 = grid[j + 1][i]
+            x = j * cs
+            y = i * cs
+            p = (
+                (x + reference_interp(threshold, c0, c1) * cs, y),
+                (x + cs, y + reference_interp(threshold, c1, c2) * cs),
+                (x + reference_interp(threshold, c3, c2) * cs, y + cs),
+                (x, y + reference_interp(threshold, c0, c3) * cs),
+            )
+            idx = (c0 > threshold) | (c1 > threshold) << 1
+            idx |= (c2 > threshold) << 2 | (c3 > threshold) << 3
+            segments += [(p[a], p[b]) for a, b in point_pairs.get(idx, [])]
+    return segments
+
+
+def reference_marching_squares_poly(grid, cs, rows, cols, thr):
+    """The original TABLE-driven polygon loop."""
+    polys = []
+    for i in range(rows):
+        for j in range(cols):
+            c0 = grid[i][j]
+            c1 = grid[i][j + 1]
+            c2 = grid[i + 1][j + 1]
+            c3 = grid[i + 1][j]
+            row_pos = i * cs
+            col_pos = j * cs
+            pts = {
+                "v0": (row_pos, col_pos),
+                "v1": (row_pos, col_pos + cs),
+                "v2": (row_pos + cs, col_pos + cs),
+                "v3": (row_pos + cs, col_pos),
+                "p_top": (row_pos, col_pos + reference_interp(thr, c0, c1) * cs),
+                "p_right": (row_pos + reference_interp(thr, c1, c2) * cs, col_pos + cs),
+                "p_bottom": (row_pos + cs, col_pos + reference_interp(thr, c3, c2) * cs),
+                "p_left": (row_pos + reference_interp(thr, c0, c3) * cs, col_pos),
+            }
+            idx = (c0 > thr) | (c1 > thr) << 1 | (c2 > thr) << 2 | (c3 > thr) << 3
+            if idx == 15:
+                polys.append([pts["v0"], pts["v1"], pts["v2"], pts["v3"]])
+                continue
+            for spec in TABLE.get(idx, []):
+                compact = []
+                for p in (pts[name] for name in spec):
+                    if not compact or (
+                        abs(p[0] - compact[-1][0]) > 1e-9 or abs(p[1] - compact[-1][1]) > 1e-9
+                    ):
+                        compact.append(p)
+                if len(compact) >= 3:
+                    polys.append(compact)
+    return polys
+
+
+def sorted_polygons(groups):
+    return sorted(np.round(p, 9).tolist() for group in groups for p in group)
+
+
+def sample_grids():
+    rng = np.random.default_rng(7)
+    smooth = rng.random((ROWS + 1, COLS + 1))
+    # Quantized levels give plenty of equal corners and corners exactly on the threshold.
+    levels = np.round(smooth * 4) / 4
+    return smooth, levels, np.zeros_like(smooth), np.ones_like(smooth)
+
+
+class MarchingSquaresTest(unittest.TestCase):
+
+    def test_segments_match_reference(self) -> None:
+        for grid in sample_grids():
+            expected = reference_marching_squares(grid.tolist(), CELL_SIZE, ROWS, COLS, THRESHOLD)
+            got = marching_squares(grid, CELL_SIZE, THRESHOLD)
+            self.assertEqual((len(expected), 2, 2), got.shape)
+            np.testing.assert_allclose(np.reshape(expected, (-1, 2, 2)), got, atol=1e-9)
+
+    def test_polygons_match_table(self) -> None:
+        for grid in sample_grids():
+            for thr in (THRESHOLD, 0.25, 0.8):
+                rows = grid.tolist()
+                expected = reference_marching_squares_poly(rows, CELL_SIZE, ROWS, COLS, thr)
+                groups = marching_squares_poly(grid, CELL_SIZE, thr)
+                got = [poly for group in groups for poly in group]
+                self.assertEqual(
+                    sorted(np.round(np.asarray(p, dtype=float), 9).tolist() for p in expected),
+                    sorted(np.round(p, 9).tolist() for p in got),
+                )
+
+
+class ContourCacheTest(unittest.TestCase):
+
+    def test_patched_contours_match_full_march(self) -> None:
+        rng = np.random.default_rng(11)
+        grid = np.round(rng.random((ROWS + 1, COLS + 1)) * 8) / 8
+        segments = ContourCache(CELL_SIZE, THRESHOLD)
+        polygons = ContourCache(CELL_SIZE, THRESHOLD, polygons=True)
+        segments.update(grid)
+        polygons.update(grid)
+        self.assertEqual(ROWS * COLS, len(segments.dirty))
+
+        for _ in range(5):
+            grid = grid.copy()
+            changed = rng.integers(0, grid.size, 20)
+            grid.flat[changed] = np.round(rng.random(20) * 8) / 8
+            np.testing.assert_array_equal(
+                marching_squares(grid, CELL_SIZE, THRESHOLD), segments.update(grid)
+            )
+            self.assertEqual(
+                sorted_polygons(marching_squares_poly(grid, CELL_SIZE, THRESHOLD)),
+                sorted_polygons(polygons.update(grid)),
+            )
+            self.assertLessEqual(len(polygons.dirty), 4 * len(changed))
+
+        before = polygons.contours
+        self.assertIs(before, polygons.update(grid))
+        self.assertEqual(0, len(polygons.dirty))
+
+    def test_cells_far_from_threshold_are_not_marched(self) -> None:
+        grid = np.zeros((ROWS + 1, COLS + 1))
+        cache = ContourCache(CELL_SIZE, THRESHOLD, polygons=True)
+        cache.update(grid)
+        grid = grid.copy()
+        grid[5, 5] = 0.25
+        cache.update(grid)
+        self.assertEqual(0, len(cache.dirty))
+        grid = grid.copy()
+        grid[5, 5] = 1.0
+        cache.update(grid)
+        self.assertEqual(4, len(cache.dirty))
+
+    def test_same_grid_view_is_not_compared_again(self) -> None:
+        game = GridViewGame()
+        grid = np.round(np.random.default_rng(5).random((ROWS + 1, COLS + 1)) * 8) / 8
+        levels = wire.quantize(grid, wire.GRID_BITS)
+        cache = ContourCache(CELL_SIZE, THRESHOLD)
+        contours = cache.update(game.grid_view("vision", levels, wire.GRID_BITS))
+        seen = cache.grid
+        cache.update(game.grid_view("vision", levels.copy(), wire.GRID_BITS))
+        self.assertIs(seen, cache.grid)
+        self.assertIs(contours, cache.contours)
+        self.assertEqual(0, len(cache.dirty))
+
+
+class GridViewGame(Game):
+    def __init__(self) -> None:
+        self.grid_views = {}
+
+
+class RasterFogTest(unittest.TestCase):
+
+    def test_fog_alpha(self) -> None:
+        alpha = fog_alpha([0.0, 0.4, THRESHOLD, 0.6, 1.0], THRESHOLD, 0.1)
+        np.testing.assert_allclose([0.0, 0.0, 0.5, 1.0, 1.0], alpha, atol=1e-9)
+
+    def test_render_scales_visible_grid(self) -> None:
+        grid = np.zeros((ROWS + 1, COLS + 1))
+        grid[10:, :] = 1.0
+        fog = RasterFog(CELL_SIZE, THRESHOLD)
+        size = (20 * CELL_SIZE, 10 * CELL_SIZE)
+        image, position = fog.render(grid, 1.0, (0.0, 0.0), size)
+        self.assertEqual([-CELL_SIZE // 2, -CELL_SIZE // 2], position)
+        self.assertGreaterEqual(image.get_width(), size[0])
+        self.assertGreaterEqual(image.get_height(), size[1])
+        alpha = pygame.surfarray.array_alpha(image)
+        self.assertEqual(0, alpha[: 8 * CELL_SIZE].max())
+        self.assertEqual(150, alpha[12 * CELL_SIZE :].min())
+
+        self.assertIs(image, fog.render(grid, 1.0, (1.0, 1.0), size)[0])
+        self.assertIsNot(image, fog.render(grid.copy(), 1.0, (1.0, 1.0), size)[0])
+
+
+class TerrainTilesTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        grid = sample_grids()[0]
+        self.layers = [
+            ((0, 220, 255), marching_squares_poly(grid, CELL_SIZE, 0.2)),
+            ((150, 150, 150), marching_squares_poly(grid, CELL_SIZE, 0.7)),
+        ]
+        self.cities = np.array([[100.0, 120.0], [640.0, 350.0]])
+
+    def test_tiles_match_whole_world(self) -> None:
+        zoom = 0.75
+        size = (int(WORLD_X * zoom), int(WORLD_Y * zoom))
+        expected = pygame.Surface(size, pygame.SRCALPHA)
+        for color, polygons in self.layers:
+            for group in polygons:
+                for poly in (group * zoom).astype(int).tolist():
+                    pygame.draw.polygon(expected, color, poly, 0)
+        for x, y in self.cities.tolist():
+            center = (int(x * zoom), int(y * zoom))
+            pygame.draw.circle(expected, (255, 215, 0), center, int(15 * zoom))
+
+        got = pygame.Surface(size, pygame.SRCALPHA)
+        TerrainTiles(self.layers, self.cities, tile_size=100).blit(got, zoom, (0, 0))
+        np.testing.assert_array_equal(
+            pygame.surfarray.array3d(expected), pygame.surfarray.array3d(got)
+        )
+        np.testing.assert_array_equal(
+            pygame.surfarray.array_alpha(expected), pygame.surfarray.array_alpha(got)
+        )
+
+    def test_least_recently_used_tiles_are_dropped(self) -> None:
+        tiles = TerrainTiles(self.layers, self.cities, tile_size=64, budget=2 * 64 * 64 * 4)
+        first = tiles.tile(1.0, 0, 0)
+        tiles.tile(1.0, 1, 0)
+        self.assertIs(first, tiles.tile(1.0, 0, 0))
+        tiles.tile(2.0, 0, 0)
+        self.assertEqual([(1.0, 0, 0), (2.0, 0, 0)], list(tiles.tiles))
+        self.assertLessEqual(tiles.used, tiles.budget)
+
+        screen = pygame.Surface((200, 100))
+        tiles.blit(screen, 1.0, (-100, -30))
+        self.assertEqual(2, len(tiles.tiles))
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def test_near_matches_brute_force(self) -> None:
+        rng = np.random.default_rng(3)
+        positions = rng.random((300, 2)) * (WORLD_X, WORLD_Y)
+        index = SpatialIndex(positions)
+        for point in rng.random((20, 2)) * (WORLD_X, WORLD_Y):
+            for radius in (5.0, 50.0, 200.0):
+                expected = np.flatnonzero(((positions - point) ** 2).sum(axis=1) <= radius**2)
+                self.assertEqual(expected.tolist(), sorted(index.near(point, radius).tolist()))
+        self.assertEqual([], SpatialIndex(np.zeros((0, 2))).near((1.0, 1.0), 10.0).tolist())
+
+
+class OverlayTest(unittest.TestCase):
+
+    def test_clear_and_cull(self) -> None:
+        overlay = Overlay((200, 100))
+        overlay.segments((0, 0, 0), [[[10, 10], [50, 60]], [[-50, 10], [-10, 60]]], 3)
+        overlay.lines((0, 0, 0), [[190, 50], [250, 50], [300, 80]], 3)
+        overlay.draw(pygame.draw.circle, (255, 0, 0), (100, 50), 7)
+        self.assertEqual(3, len(overlay.drawn))
+        self.assertGreater(pygame.surfarray.array_alpha(overlay.surface).sum(), 0)
+
+        screen = pygame.Surface((200, 100))
+        screen.fill((255, 255, 255))
+        overlay.blit_to(screen)
+        self.assertEqual((255, 0, 0, 255), tuple(screen.get_at((100, 50))))
+
+        overlay.clear()
+        self.assertEqual([], overlay.drawn)
+        self.assertEqual(0, pygame.surfarray.array_alpha(overlay.surface).sum())
+
+
+class ReceiverTest(unittest.TestCase):
+
+    def test_keeps_newest_and_sends_when_asked(self) -> None:
+        server, conn = socket.socketpair()
+        self.addCleanup(server.close)
+        client = simple_socket.Client(None, None)
+        client.client = conn
+        self.addCleanup(client.close)
+        receiver = Receiver(client, 3)
+        receiver.start()
+
+        env = DeterministicEnvironment()
+        for _ in range(3):
+            env.update_troops([])
+            server.sendall(simple_socket.frame(wire.encode_snapshot(3, env.snapshot(0))))
+        latest = receiver.take(timeout=5)
+        while latest is not None and latest[0].tick != env.tick:
+            latest = receiver.take(timeout=5)
+        if latest is None:
+            self.fail("no update for the last tick")
+        self.assertLessEqual(latest[1], time.perf_counter())
+        self.assertIsNone(receiver.take())
+
+        receiver.send([[(7, [(1.0, 2.0)])], []])
+        self.assertEqual(
+            (env.tick, [[(7, [[1.0, 2.0]])], []]),
+            wire.decode_input(simple_socket.recv_message(server)),
+        )
+        receiver.heartbeat()  # too soon after the orders
+        receiver.sent -= wire.HEARTBEAT
+        receiver.heartbeat()
+        self.assertEqual(
+            (env.tick, [[], []]), wire.decode_input(simple_socket.recv_message(server))
+        )
+        server.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            server.recv(1)
+
+        server.close()
+        receiver.join(timeout=5)
+        self.assertFalse(receiver.running)
+        self.assertIsNone(receiver.take())
+
+
+class InterpolatorTest(unittest.TestCase):
+
+    def snapshot(self, tick, ids, positions):
+        env = DeterministicEnvironment()
+        snap = env.snapshot(0)
+        snap.tick = tick
+        snap.troop_ids = np.array(ids, dtype=np.uint32)
+        snap.troop_positions = np.array(positions, dtype=np.float32).reshape(-1, 2)
+        return snap
+
+    def test_moves_from_drawn_position_over_one_interval(self) -> None:
+        motion = Interpolator(max_extrapolation=0.5, smoothing=1.0)
+        first = self.snapshot(10, [1, 2], [[0, 0], [50, 50]])
+        motion.add(first, 0.0)
+        np.testing.assert_array_equal(first.troop_positions, motion.positions(0.05))
+
+        motion.add(self.snapshot(12, [2, 1, 3], [[60, 50], [10, 0], [99, 99]]), 0.1)
+        np.testing.assert_allclose([[50, 50], [0, 0], [99, 99]], motion.positions(0.1))
+        np.testing.assert_allclose([[55, 50], [5, 0], [99, 99]], motion.positions(0.15))
+        np.testing.assert_allclose([[60, 50], [10, 0], [99, 99]], motion.positions(0.2))
+        # A late snapshot: capped extrapolation.
+        np.testing.assert_allclose([[65, 50], [15, 0], [99, 99]], motion.positions(0.25))
+        np.testing.assert_allclose([[65, 50], [15, 0], [99, 99]], motion.positions(1.0))
+
+        # An early snapshot: troop 1 carries on from where it was drawn.
+        motion = Interpolator(smoothing=1.0)
+        motion.add(first, 0.0)
+        motion.add(self.snapshot(12, [2, 1], [[60, 50], [10, 0]]), 0.1)
+        motion.add(self.snapshot(13, [1], [[20, 0]]), 0.125)
+        np.testing.assert_allclose([[2.5, 0]], motion.positions(0.125))
+        np.testing.assert_allclose([[11.25, 0]], motion.positions(0.1375))
+        np.testing.assert_allclose([[20, 0]], motion.positions(0.15))
+
+    def test_repeated_tick_does_not_move(self) -> None:
+        motion = Interpolator()
+        snap = self.snapshot(5, [1], [[3, 4]])
+        motion.add(snap, 0.0)
+        motion.add(snap, 0.1)
+        np.testing.assert_array_equal(snap.troop_positions, motion.positions(0.2))
+
+    def test_repeated_tick_mid_interpolation_keeps_moving(self) -> None:
+        motion = Interpolator(smoothing=1.0)
+        motion.add(self.snapshot(0, [1], [[0, 0]]), 0.0)
+        latest = self.snapshot(3, [1], [[30, 0]])
+        motion.add(latest, 0.1)
+        np.testing.assert_allclose([[15, 0]], motion.positions(0.15))
+
+        motion.add(self.snapshot(3, [1], [[30, 0]]), 0.15)
+        motion.add(self.snapshot(2, [1], [[20, 0]]), 0.15)
+        np.testing.assert_allclose([[15, 0]], motion.positions(0.15))
+        np.testing.assert_allclose([[30, 0]], motion.positions(0.2))
+        self.assertIs(latest, motion.current)
+
+        # A rebuilt snapshot of the same tick brings in its new troop, the rest carry on.
+        rebuilt = self.snapshot(3, [2, 1], [[99, 99], [30, 0]])
+        motion.add(rebuilt, 0.15)
+        self.assertIs(rebuilt, motion.current)
+        np.testing.assert_allclose([[99, 99], [15, 0]], motion.positions(0.15))
+
+
+class SpriteCacheTest(unittest.TestCase):
+
+    def test_sprites_match_direct_drawing(self) -> None:
+        cache = SpriteCache()
+        for zoom_idx, zoom in enumerate((0.3, 1.0, 2.7)):
+            reach = int(35 * zoom) + 4
+            r = max(1, int(7 * zoom))
+            looks = [(draw_flag, zoom, (0, 0, 255))] + [
+                (draw_troop, zoom, (255, 150, 0), width, selected)
+                for width in (0, r, 2 * r)
+                for selected in (False, True)
+            ]
+            for draw, *args in looks:
+                expected = pygame.Surface((200, 200), pygame.SRCALPHA)
+                draw(expected, (100, 100), *args)
+                got = pygame.Surface((200, 200), pygame.SRCALPHA)
+                image, (ax, ay) = cache.get((draw, *args), zoom_idx, reach, draw, *args)
+                got.blit(image, (100 - ax, 100 - ay))
+                np.testing.assert_array_equal(
+                    pygame.surfarray.array3d(expected), pygame.surfarray.array3d(got)
+                )
+                np.testing.assert_array_equal(
+                    pygame.surfarray.array_alpha(expected), pygame.surfarray.array_alpha(got)
+                )
+
+    def test_zoom_change_drops_sprites(self) -> None:
+        cache = SpriteCache()
+        args = (1.0, (255, 0, 0), 10, False)
+        first = cache.get("troop", 3, 40, draw_troop, *args)
+        self.assertIs(first, cache.get("troop", 3, 40, draw_troop, *args))
+        cache.get("troop", 4, 40, draw_troop, 1.25, (255, 0, 0), 10, False)
+        self.assertEqual(["troop"], list(cache.sprites))
+        self.assertIsNot(first, cache.get("troop", 3, 40, draw_troop, *args))
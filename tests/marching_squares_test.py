@@ -1,9 +1,11 @@
+import math
+import random
 import unittest
 
 import numpy as np
 
-from constants import CELL_SIZE
-from wod_server import City, Environment, MarchingSquares
+from constants import CELL_SIZE, COLS, ROWS
+from wod_server import Brush, City, Environment, MarchingSquares
 
 albany = City((3 * CELL_SIZE, 4 * CELL_SIZE))
 boston = City((5 * CELL_SIZE, 6 * CELL_SIZE))
@@ -22,6 +24,25 @@ class DeterministicEnvironment(Environment):
         self.generate_default_vision()
 
 
+def reference_brush_apply(brush: Brush, grid: np.ndarray, pos, target_value: float) -> None:
+    """The original per-cell Brush.apply loop, kept to check the kernel version against."""
+    mx, my = pos
+    cs = CELL_SIZE
+    r = float(brush.radius)
+    col_start = max(0, int((my - r) / cs))
+    col_end = min(COLS, int((my + r) / cs) + 1)
+    row_start = max(0, int((mx - r) / cs))
+    row_end = min(ROWS, int((mx + r) / cs) + 1)
+    for j in range(row_start, row_end):
+        for i in range(col_start, col_end):
+            dist_sq = (i * cs - my) ** 2 + (j * cs - mx) ** 2
+            if dist_sq <= r * r:
+                t = math.sqrt(dist_sq) / r
+                weight = brush.strength + t * (brush.falloff - brush.strength)
+                old = grid[j, i]
+                grid[j, i] = max(0.0, min(1.0, old + (target_value - old) * weight))
+
+
 class MarchingSquaresTest(unittest.TestCase):
 
     def test_get_grid_value(self) -> None:
@@ -29,6 +50,15 @@ class MarchingSquaresTest(unittest.TestCase):
         self.assertAlmostEqual(0.0, ms.get_grid_value(5.0, 6.0))
         self.assertAlmostEqual(0.0, ms.get_grid_value(5.2, 6.2))
 
+    def test_sample_many(self) -> None:
+        env = DeterministicEnvironment()
+        xs = [3.2, 4.0, 3.5, 0.0, 64.0]
+        ys = [4.2, 4.0, 4.9, 0.0, 35.0]
+        many = env.forest_marching.sample_many(xs, ys)
+        self.assertEqual((5,), many.shape)
+        for x, y, value in zip(xs, ys, many):
+            self.assertAlmostEqual(env.forest_marching.get_grid_value(x, y), value)
+
     def _check_marching(self, env: Environment) -> None:
         self.assertAlmostEqual(0.7424, env.forest_marching.get_grid_value(3.2, 4.2))
 
@@ -91,3 +121,39 @@ class MarchingSquaresTest(unittest.TestCase):
         self.assertEqual(10.0, sum(new[10, :]))
         self.assertEqual(7.0, sum(new[11, :]))
         self.assertEqual(0.0, sum(new[12, :]))
+
+    def test_brush_kernel_matches_reference(self) -> None:
+        rng = random.Random(1)
+        for brush in [Brush(75, 1, 0), Brush(175, 1, 0), Brush(40, 0.05, 0), Brush(30, 0.8, 0.3)]:
+            ms = MarchingSquares()
+            ms.set_grid(np.random.default_rng(2).random((ROWS + 1, COLS + 1)))
+            expected = ms.grid.astype(float)
+            on_lattice = [(60.0, 80.0), (0.0, 0.0), (1280.0, 700.0), (102.5, 397.5)]
+            off_lattice = [(rng.uniform(-50, 1330), rng.uniform(-50, 750)) for _ in range(20)]
+
+            for pos in on_lattice:
+                brush.apply(ms, pos, 1.0)
+                reference_brush_apply(brush, expected, pos, 1.0)
+            np.testing.assert_allclose(expected, ms.grid, atol=1e-6)
+
+            for pos in off_lattice:
+                target = rng.choice([0.0, 1.0])
+                before = ms.grid.astype(float)
+                brush.apply(ms, pos, target)
+                reference_brush_apply(brush, before, pos, target)
+                np.testing.assert_allclose(before, ms.grid, atol=brush.max_weight_error() + 1e-6)
+
+    def test_brush_apply_many_matches_sequential(self) -> None:
+        rng = random.Random(3)
+        positions = [(rng.uniform(-100, 1380), rng.uniform(-100, 800)) for _ in range(200)]
+        for brush in [Brush(75, 1, 0), Brush(175, 1, 0), Brush(40, 0.05, 0), Brush(30, 0.8, 0.3)]:
+            # Values past [0, 1], like default vision, are clipped by the first stamp only.
+            grid = np.random.default_rng(4).random((ROWS + 1, COLS + 1)) * 2.5 - 0.3
+            for target in [0.0, 1.0]:
+                one, many = MarchingSquares(), MarchingSquares()
+                one.set_grid(grid)
+                many.set_grid(grid)
+                for pos in positions:
+                    brush.apply(one, pos, target)
+                brush.apply_many(many, positions, target)
+                np.testing.assert_allclose(one.grid, many.grid, atol=1e-6)
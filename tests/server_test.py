@@ -1,6 +1,28 @@
+import asyncio
+import sys
+import threading
+import time
 import unittest
 
-from wod_server import xy_to_dir_dis
+import numpy as np
+
+import simple_socket
+import wire
+from constants import CELL_SIZE, PLAYERS, TERRAIN_VALUES, THRESHOLD
+from tests.marching_squares_test import DeterministicEnvironment
+from wod_server import (
+    ATTACK_RANGE,
+    FOREST,
+    KEYFRAME_TICKS,
+    TERRAIN_CLASSES,
+    FixedTimestep,
+    Game,
+    SnapshotCache,
+    SpatialHash,
+    TroopTable,
+    troop_pairs,
+    xy_to_dir_dis,
+)
 
 
 class ServerTest(unittest.TestCase):
@@ -9,3 +31,346 @@ class ServerTest(unittest.TestCase):
         direc, dist = xy_to_dir_dis((3.0, 4.0))
         self.assertEqual(53.13, round(direc, 2))  # degrees, not radians
         self.assertEqual(5.0, dist)
+
+
+class SpatialHashTest(unittest.TestCase):
+
+    def test_pairs_cover_attack_range(self) -> None:
+        sh = SpatialHash(ATTACK_RANGE, [(100.0, 100.0), (131.9, 100.0), (200.0, 100.0)])
+        _, found = sh.pairs([(100.0, 100.0)])
+        self.assertEqual([0, 1], sorted(found.tolist()))
+        self.assertEqual(0, len(SpatialHash(ATTACK_RANGE).pairs([(100.0, 100.0)])[0]))
+
+    def test_pairs_match_brute_force(self) -> None:
+        rng = np.random.default_rng(5)
+        points, groups = rng.random((80, 2)) * 300 - 50, rng.integers(0, 3, 80)
+        queries, asking = rng.random((50, 2)) * 500 - 150, rng.integers(0, 4, 50)
+        query_idx, point_idx = SpatialHash(32, points, groups).pairs(queries, asking)
+        found = set(zip(query_idx.tolist(), point_idx.tolist()))
+        self.assertEqual(len(query_idx), len(found))
+
+        buckets = np.floor(points / 32)
+        expected = {
+            (q, p)
+            for q, bucket in enumerate(np.floor(queries / 32))
+            for p in range(len(points))
+            if asking[q] == groups[p] and np.all(np.abs(buckets[p] - bucket) <= 1)
+        }
+        self.assertEqual(expected, found)
+
+    def test_troop_pairs_within_reach(self) -> None:
+        rng = np.random.default_rng(6)
+        positions, owners = rng.random((200, 2)) * 400, rng.integers(0, 3, 200)
+        for friendly in [True, False]:
+            mine, other = troop_pairs(owners, 3, positions, positions, 15, friendly)
+            found = set(zip(mine.tolist(), other.tolist()))
+            offsets = positions[:, None] - positions
+            for i, j in np.argwhere(np.hypot(offsets[..., 0], offsets[..., 1]) < 15):
+                if i != j and (owners[i] == owners[j]) == friendly:
+                    self.assertIn((i, j), found)
+            self.assertTrue(all((owners[i] == owners[j]) == friendly for i, j in found))
+            self.assertTrue(all(i != j for i, j in found))
+
+
+class TroopTableTest(unittest.TestCase):
+
+    def test_compact_swap_removes_dead(self) -> None:
+        table = TroopTable(capacity=2)
+        for i in range(5):  # Forces one grow().
+            table.add(i + 1, (10.0 * i, 0.0), i % 2)
+        self.assertEqual(5, len(table))
+        self.assertEqual(3, table.count_owned(0))
+
+        table.alive[[0, 3]] = False
+        table.compact()
+        self.assertEqual(3, len(table))
+        self.assertEqual([5, 2, 3], table.id[:3].tolist())
+        self.assertEqual([40.0, 10.0, 20.0], table.position[:3, 0].tolist())
+        self.assertEqual(3, len(table.paths))
+        self.assertEqual({5: 0, 2: 1, 3: 2}, table.slots)
+
+
+class LazyVisionTest(unittest.TestCase):
+
+    def test_vision_is_stamped_once_per_tick(self) -> None:
+        env = DeterministicEnvironment()
+        before = env.get_vision(0)
+        np.testing.assert_array_equal(env.default_vision.astype(np.float32), before.grid)
+
+        env.update_troops([])
+        vision = env.get_vision(0)
+        self.assertIs(vision, env.get_vision(0))
+        self.assertEqual(env.tick, env.players[0].vision_tick)
+        self.assertEqual(0.0, vision.get_grid_value(3.0, 4.0))  # Albany, owned by player 0.
+        self.assertEqual(0, env.players[1].vision_tick)  # Never asked for, never stamped.
+
+
+class TerrainClassTest(unittest.TestCase):
+
+    def test_raster_matches_grid_classification(self) -> None:
+        env = DeterministicEnvironment()
+        self.assertEqual(FOREST, env.terrain_class_at((3 * CELL_SIZE, 4 * CELL_SIZE)))
+        self.assertEqual("water", TERRAIN_CLASSES[env.terrain_class_at((0.0, 0.0))])
+        self.assertEqual("water", TERRAIN_CLASSES[env.terrain_class_at((-50.0, 9999.0))])
+
+        env.terrain_marching.grid[6][7] = 0.9
+        env.generate_terrain_classes()
+        for x, y in [(6.0, 7.0), (6.25, 7.0), (5.75, 7.25), (3.5, 4.0)]:
+            terrain = env.terrain_marching.get_grid_value(x, y)
+            forest = env.forest_marching.get_grid_value(x, y)
+            expected = "forest" if forest > THRESHOLD else "water"
+            for name, value in TERRAIN_VALUES.items():
+                if forest <= THRESHOLD and terrain > value:
+                    expected = name
+            position = (x * CELL_SIZE, y * CELL_SIZE)
+            self.assertEqual(expected, TERRAIN_CLASSES[env.terrain_class_at(position)])
+
+
+class HealingFieldTest(unittest.TestCase):
+
+    def test_nearest_city_follows_ownership(self) -> None:
+        env = DeterministicEnvironment()
+        _, boston = env.cities
+        sub = env.terrain_subdivisions
+        self.assertEqual(0, env.nearest_city[0][5 * sub, 6 * sub])  # Boston is player 1's.
+
+        env.players_in_cities[1] = [env.players[0]]
+        env.update_cities([])
+        self.assertIs(env.players[0], boston.owner)
+        self.assertEqual(1, env.nearest_city[0][5 * sub, 6 * sub])
+        self.assertIsNone(env.nearest_city[1])
+
+    def test_border_obstruction_matches_per_ray_samples(self) -> None:
+        env = DeterministicEnvironment()
+        rng = np.random.default_rng(3)
+        for player in env.players:
+            player.border.set_grid(rng.random(player.border.grid.shape))
+        origins = np.array([[60.0, 80.0], [100.0, 120.0], [300.0, 300.0]])
+        offsets = np.array([[130.0, 45.0], [-10.0, 5.0], [0.0, -95.0]])
+        dists = np.hypot(offsets[:, 0], offsets[:, 1])
+
+        got = env.border_obstruction(env.players, origins, offsets, dists)
+        for (cx, cy), (ox, oy), dist, avg in zip(origins, offsets, dists, got):
+            steps = int(dist // 20)
+            samples = [
+                player.border.get_grid_value(
+                    (cx + ox / dist * k * 20) / CELL_SIZE, (cy + oy / dist * k * 20) / CELL_SIZE
+                )
+                for player in env.players
+                for k in range(steps)
+            ]
+            self.assertAlmostEqual(sum(samples) / len(samples) if samples else 0.0, avg, places=5)
+
+
+class EntityIdTest(unittest.TestCase):
+
+    def test_orders_follow_stable_ids(self) -> None:
+        env = DeterministicEnvironment()
+        ids = [city.id for city in env.cities] + env.troops.id[: len(env.troops)].tolist()
+        self.assertEqual(len(ids), len(set(ids)))
+
+        tid = env.add_troop((200.0, 200.0), 0)
+        env.troops.health[env.troops.slots[tid]] = -1
+        env.update_troops([])
+        self.assertNotIn(tid, env.troops.slots)
+        newer = env.add_troop((200.0, 200.0), 0)
+        self.assertGreater(newer, tid)
+
+        env.update_troops([[tid, [[0.0, 0.0]]], [newer, [[1.0, 1.0]]], [newer, [[210.0, 200.0]]]])
+        self.assertEqual([[210.0, 200.0]], env.troops.paths[env.troops.slots[newer]])
+
+        boston = env.cities[1]
+        env.update_cities([[boston.id, [[1.0, 2.0]]], [-1, [[3.0, 4.0]]]])
+        self.assertEqual([[1.0, 2.0]], boston.path)
+
+
+class FixedTimestepTest(unittest.TestCase):
+
+    def test_catch_up_and_overrun_accounting(self) -> None:
+        now = [0.0]
+        sched = FixedTimestep(10, max_catch_up=3, clock=lambda: now[0])
+        self.assertEqual(0, sched.due())
+        self.assertAlmostEqual(0.1, sched.time_to_next())
+
+        now[0] = 0.1
+        self.assertEqual(1, sched.due())
+        now[0] = 0.35  # A slow tick: two more are due, with 50 ms left over.
+        self.assertEqual(2, sched.due())
+        self.assertEqual(1, sched.overruns)
+        self.assertAlmostEqual(0.15, sched.max_lag)
+        self.assertAlmostEqual(0.05, sched.time_to_next())
+
+        now[0] = 1.35  # Ten steps behind, only three may be caught up.
+        self.assertEqual(3, sched.due())
+        self.assertEqual(7, sched.dropped)
+        self.assertEqual(6, sched.ticks)
+        self.assertEqual(2, sched.overruns)
+
+
+class WorldTest(unittest.TestCase):
+
+    def test_published_world_is_frozen(self) -> None:
+        env = DeterministicEnvironment()
+        tid = env.add_troop((400.0, 300.0), 0, [[600.0, 300.0]])
+        env.update_troops([])
+        world = env.world
+        self.assertEqual(env.tick, world.tick)
+        with self.assertRaises(ValueError):
+            world.troop_positions[0, 0] = 0.0
+
+        env.update_troops([])
+        self.assertIsNot(world, env.world)
+        self.assertEqual(env.tick - 1, world.tick)
+        slot = list(world.troop_ids).index(tid)
+        moved = env.world.troop_positions[list(env.world.troop_ids).index(tid)]
+        self.assertNotEqual(moved.tolist(), world.troop_positions[slot].tolist())
+        self.assertEqual(world.tick, env.snapshot(0, world=world).tick)
+
+
+class SnapshotCacheTest(unittest.TestCase):
+
+    def test_one_encoding_per_player_and_tick(self) -> None:
+        env = DeterministicEnvironment()
+        cache = SnapshotCache(env)
+        message, snap = cache.message(3, 0, None)
+        self.assertIs(message, cache.message(3, 0, None)[0])  # a spectator of player 0
+        self.assertIsNot(message, cache.message(3, 1, None)[0])
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+        env.update_troops([])
+        delta, rebuilt = cache.message(3, 0, snap)
+        self.assertIs(delta, cache.message(3, 0, snap)[0])
+        self.assertEqual(env.tick, rebuilt.tick)
+        self.assertEqual([(3, 0, snap.tick)], list(cache.messages))
+
+    def test_one_keyframe_per_window_while_acks_lag(self) -> None:
+        game = Game()
+        game.environment = env = DeterministicEnvironment()
+        game.snapshot_cache = SnapshotCache(env)
+        history = wire.History()
+        _, keyframe = game.view_message(3, 0, history, None, None)
+        self.assertEqual(0, keyframe)
+
+        env.tick = KEYFRAME_TICKS - 1
+        env.update_troops([])
+        _, keyframe = game.view_message(3, 0, history, 0, keyframe)
+        self.assertEqual(KEYFRAME_TICKS, keyframe)
+        env.update_troops([])
+        _, keyframe = game.view_message(3, 0, history, 0, keyframe)  # still acking tick 0
+        self.assertEqual(KEYFRAME_TICKS, keyframe)
+        self.assertIn((3, 0, 0), game.snapshot_cache.messages)
+
+
+class BrokenViewGame(Game):
+    def view_message(self, version, player, history, acked, keyframe):
+        raise RuntimeError("no view")
+
+
+class ServeTest(unittest.TestCase):
+
+    def serve(self, game_class: type[Game] = Game) -> tuple[Game, threading.Thread]:
+        # A game on a free loopback port, served from its own thread.
+        game = game_class()
+        game.environment = DeterministicEnvironment()
+        game.snapshot_cache = SnapshotCache(game.environment)
+        game.ip, game.port = "127.0.0.1", 0
+        server = threading.Thread(target=asyncio.run, args=(game.serve(),), daemon=True)
+        server.start()
+        self.addCleanup(server.join, 5)
+        self.addCleanup(setattr, game, "done", True)
+        self.wait_for(lambda: game.port != 0)
+        return game, server
+
+    def wait_for(self, condition, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            time.sleep(0.01)
+
+    def connect(self, game: Game, player_number: int) -> simple_socket.Client:
+        client = simple_socket.Client(game.ip, game.port)
+        client.connect()
+        client.client.settimeout(5)
+        self.addCleanup(client.close)
+        client.send(wire.encode_hello())
+        self.assertEqual(player_number, wire.decode_welcome(client.rcv())[1])
+        return client
+
+    def test_players_and_spectator(self) -> None:
+        game, server = self.serve()
+        tid = game.environment.add_troop((200.0, 200.0), 0)
+        players = [self.connect(game, p) for p in range(PLAYERS)]
+        spectator = self.connect(game, 0)
+        version = max(wire.VERSIONS)
+
+        # A keyframe first, then deltas against what was acked; the order shows up too.
+        history, path, deltas = wire.History(), [[600.0, 200.0]], 0
+        data = players[0].rcv()
+        self.assertEqual(wire.SNAPSHOT, data[wire.HEADER.size - 1])
+        snap = wire.decode_update(data, history)
+        orders = [[(tid, path)], []]
+        for _ in range(100):
+            history.add(snap)
+            players[0].send(wire.encode_input(version, orders, snap.tick))
+            data, orders = players[0].rcv(), [[], []]
+            deltas += data[wire.HEADER.size - 1] == wire.DELTA
+            snap = wire.decode_update(data, history)
+            if deltas and snap.troop_paths.get(tid) == path:
+                break
+        self.assertGreater(deltas, 0)
+        self.assertEqual(path, snap.troop_paths.get(tid))
+
+        spectator.send(wire.encode_input(version, "close", 0))
+        self.wait_for(lambda: len(game.open_connections) == PLAYERS)
+        self.assertFalse(game.done)
+
+        players[1].send(wire.encode_input(version, "close", 0))
+        server.join(5)
+        self.assertFalse(server.is_alive())
+        self.assertTrue(game.done)
+        self.assertEqual(set(), game.handlers)
+
+    def test_failed_snapshots_hang_up(self) -> None:
+        game, server = self.serve(BrokenViewGame)
+        players = [self.connect(game, p) for p in range(PLAYERS)]
+        for client in players:
+            self.assertEqual(b"", client.rcv())
+        server.join(5)
+        self.assertFalse(server.is_alive())
+        self.assertTrue(game.done)
+        self.assertEqual(set(), game.handlers)
+
+
+class FieldPoolTest(unittest.TestCase):
+
+    def _run(self, env: DeterministicEnvironment) -> list[np.ndarray]:
+        try:
+            env.add_troop((100.0, 100.0), 0, [[300.0, 100.0]])
+            env.add_troop((400.0, 300.0), 1)
+            for _ in range(3):
+                env.update_troops([])
+            return [env.players[p].border.grid.copy() for p in range(2)] + [
+                env.get_vision(p).grid for p in range(2)
+            ]
+        finally:
+            env.close()
+
+    @unittest.skipIf(sys.version_info < (3, 13), "SharedMemory(track=False) is new in 3.13")
+    def test_parallel_fields_match_serial(self) -> None:
+        # Each environment re-owns the shared test cities, so run them one at a time.
+        serial = self._run(DeterministicEnvironment())
+        parallel = self._run(DeterministicEnvironment(parallel=True))
+        for expected, got in zip(serial, parallel):
+            np.testing.assert_array_equal(expected, got)
+
+    @unittest.skipIf(sys.version_info < (3, 13), "SharedMemory(track=False) is new in 3.13")
+    def test_usable_after_close(self) -> None:
+        env = DeterministicEnvironment(parallel=True)
+        env.add_troop((100.0, 100.0), 0, [[300.0, 100.0]])
+        env.update_troops([])
+        border = env.players[0].border.grid.copy()
+        env.close()
+        np.testing.assert_array_equal(border, env.players[0].border.grid)
+        env.update_troops([])
+        self.assertEqual(2, env.tick)
@@ -0,0 +1,92 @@
+import unittest
+
+import numpy as np
+
+import wire
+from tests.marching_squares_test import DeterministicEnvironment
+
+
+class WireTest(unittest.TestCase):
+
+    def test_negotiate(self) -> None:
+        self.assertEqual(max(wire.VERSIONS), wire.negotiate(wire.encode_hello()))
+        self.assertIsNone(wire.negotiate(wire.encode_hello((200,))))
+        self.assertIsNone(wire.negotiate(b"GET / HTTP/1.1"))
+        with self.assertRaises(wire.ProtocolError):
+            wire.decode_welcome(wire.encode_reject())
+
+    def test_snapshot_round_trip(self) -> None:
+        env = DeterministicEnvironment()
+        start = tuple(env.troops.position[0])
+        tid = env.add_troop(start, 0, [(220.0, 150.0), (240.0, 160.0)])
+        city = env.cities[0]  # albany, player 0's start city, shared across tests
+        city.path = [(70.0, 90.0)]
+        self.addCleanup(setattr, city, "path", [])
+        env.update_troops([])  # vision comes from the previous tick's troops
+        snap = env.snapshot(player=0)
+        got = wire.decode_snapshot(wire.encode_snapshot(3, snap))
+
+        self.assertEqual(env.tick, got.tick)
+        np.testing.assert_array_equal(snap.vision, got.vision)
+        np.testing.assert_array_equal(snap.border, got.border)
+        self.assertEqual(snap.troop_ids.tolist(), got.troop_ids.tolist())
+        self.assertEqual(snap.troop_owners.tolist(), got.troop_owners.tolist())
+        np.testing.assert_allclose(snap.troop_positions, got.troop_positions)
+        self.assertEqual(snap.city_owners.tolist(), got.city_owners.tolist())
+        self.assertEqual({tid: [[220.0, 150.0], [240.0, 160.0]]}, got.troop_paths)
+        self.assertEqual({city.id: [[70.0, 90.0]]}, got.city_paths)
+
+    def test_delta_rebuilds_snapshot(self) -> None:
+        env = DeterministicEnvironment()
+        start = tuple(env.troops.position[0])
+        for offset in range(4):
+            env.add_troop((start[0] + 10 * offset, start[1]), 0, [(400.0, 300.0)])
+        env.update_troops([])
+        base = env.snapshot(player=0)
+        env.update_troops([])
+        env.troops.health[0] = -1  # culled next tick
+        env.update_troops([])
+        snap = env.snapshot(player=0)
+
+        delta = wire.decode_delta(wire.encode_delta(3, wire.make_delta(base, snap)))
+        self.assertEqual(base.tick, delta.base_tick)
+        self.assertIn(base.troop_ids[0], delta.removed_troops)
+        got = wire.apply_delta(base, delta)
+        order = np.argsort(got.troop_ids)
+        self.assertEqual(sorted(snap.troop_ids.tolist()), got.troop_ids[order].tolist())
+        np.testing.assert_allclose(
+            snap.troop_positions[np.argsort(snap.troop_ids)], got.troop_positions[order], rtol=1e-6
+        )
+        np.testing.assert_array_equal(snap.vision, got.vision)
+        np.testing.assert_array_equal(snap.border, got.border)
+        self.assertEqual(snap.troop_paths, got.troop_paths)
+
+        history = wire.History()
+        history.add(got)
+        unchanged = wire.encode_delta(3, wire.make_delta(got, got))
+        self.assertLess(len(unchanged), 50)
+        again = wire.decode_update(unchanged, history)
+        self.assertIs(got.vision, again.vision)
+        self.assertIs(got.border, again.border)
+
+    def test_quantize(self) -> None:
+        grid = np.linspace(-0.1, 1.1, wire.GRID_SIZE, dtype=np.float32).reshape(wire.GRID_SHAPE)
+        for bits in (8, 4, 1):
+            levels = wire.quantize(grid, bits)
+            self.assertEqual(np.uint8, levels.dtype)
+            step = 1 / ((1 << bits) - 1)
+            error = np.abs(wire.dequantize(levels, bits) - np.clip(grid, 0, 1))
+            self.assertLessEqual(error.max(), step / 2 + 1e-6)
+        with self.assertRaises(ValueError):
+            wire.quantize(grid, 9)
+
+    def test_input_round_trip(self) -> None:
+        for command in ("pause", "unpause", "close"):
+            self.assertEqual((4, command), wire.decode_input(wire.encode_input(3, command, 4)))
+        orders = [[(7, [(1.5, 2.5), (3.0, 4.0)])], [(2, [(5.0, 6.0)])]]
+        self.assertEqual(
+            (12, [[(7, [[1.5, 2.5], [3.0, 4.0]])], [(2, [[5.0, 6.0]])]]),
+            wire.decode_input(wire.encode_input(3, orders, 12)),
+        )
+        with self.assertRaises(wire.ProtocolError):
+            wire.decode_input(b"")
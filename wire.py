@@ -0,0 +1,534 @@
+import struct
+import zlib
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from constants import COLS, ROWS
+
+# Every message starts with HEADER.  Struct fields are network byte order, the typed
+# arrays that follow them are little-endian so both ends can view them in place.
+MAGIC = b"WoD"
+VERSIONS = (3,)  # Protocol versions this build speaks.
+
+HELLO, WELCOME, REJECT, SNAPSHOT, INPUT, DELTA = range(6)
+COMMANDS = (None, "pause", "unpause", "close")
+HEARTBEAT = 0.25  # Seconds between client inputs while it has nothing else to send.
+
+HEADER = struct.Struct("!3sBB")  # magic, version, message type
+BYTE = struct.Struct("!B")
+COUNT = struct.Struct("!I")
+WELCOME_HEAD = struct.Struct("!BBH")  # player number, players, cities
+SNAPSHOT_HEAD = struct.Struct("!IBII")  # tick, grid bits, troops, cities
+DELTA_HEAD = struct.Struct("!IIIII")  # tick, base tick, removed troops, troops, cities
+GRID_HEAD = struct.Struct("!BI")  # GRID_ZLIB or 0, payload bytes
+ACK = struct.Struct("!I")  # tick of the newest snapshot the client has applied
+
+GRID_SHAPE = (ROWS + 1, COLS + 1)
+GRID_SIZE = GRID_SHAPE[0] * GRID_SHAPE[1]
+GRID_BITS = 8  # Vision and border grids are sent as levels of this many bits, up to 8.
+GRID_ZLIB = 1
+
+
+class ProtocolError(Exception):
+    pass
+
+
+@dataclass
+class Snapshot:
+    # One player's view of one tick.  Grids are quantized levels, see dequantize().  Owners
+    # are player indices, -1 for no owner; paths are only sent for the viewing player's own
+    # troops and cities, keyed by entity ID.
+    tick: int
+    vision: np.ndarray
+    border: np.ndarray
+    troop_ids: np.ndarray
+    troop_owners: np.ndarray
+    troop_positions: np.ndarray
+    troop_health: np.ndarray
+    city_ids: np.ndarray
+    city_owners: np.ndarray
+    city_positions: np.ndarray
+    grid_bits: int = GRID_BITS
+    troop_paths: dict = field(default_factory=dict)
+    city_paths: dict = field(default_factory=dict)
+
+
+@dataclass
+class Delta:
+    # Changes from the snapshot at base_tick: grid levels by flat cell index, troops and
+    # cities that are new or changed, troops that left view, and paths (empty once cleared).
+    tick: int
+    base_tick: int
+    vision_cells: np.ndarray
+    vision_values: np.ndarray
+    border_cells: np.ndarray
+    border_values: np.ndarray
+    removed_troops: np.ndarray
+    troop_ids: np.ndarray
+    troop_owners: np.ndarray
+    troop_positions: np.ndarray
+    troop_health: np.ndarray
+    city_ids: np.ndarray
+    city_owners: np.ndarray
+    city_positions: np.ndarray
+    troop_paths: dict = field(default_factory=dict)
+    city_paths: dict = field(default_factory=dict)
+
+
+def quantize(grid, bits=GRID_BITS):
+    if not 1 <= bits <= 8:
+        raise ValueError(f"grid bits must be between 1 and 8, not {bits}")
+    top = (1 << bits) - 1
+    return np.rint(np.clip(grid, 0.0, 1.0) * top).astype(np.uint8)
+
+
+def dequantize(levels, bits=GRID_BITS):
+    return levels * np.float32(1 / ((1 << bits) - 1))
+
+
+def grid_hash(levels):
+    return zlib.crc32(np.ascontiguousarray(levels))
+
+
+class History:
+    # Recent snapshots by tick, as the client has them.  Deltas are made and applied
+    # against these, so both ends must store what apply_delta gives rather than the truth.
+    def __init__(self, size=64):
+        self.size = size
+        self.snapshots = {}
+
+    def add(self, snap):
+        self.snapshots[snap.tick] = snap
+        while len(self.snapshots) > self.size:
+            del self.snapshots[min(self.snapshots)]
+
+    def get(self, tick):
+        return self.snapshots.get(tick)
+
+    def discard_before(self, tick):
+        for old in [t for t in self.snapshots if t < tick]:
+            del self.snapshots[old]
+
+
+def _match(base_ids, ids):
+    # Index of each of ids in base_ids, -1 where it is missing.
+    if not len(base_ids):
+        return np.full(len(ids), -1)
+    order = np.argsort(base_ids)
+    idx = order[np.minimum(np.searchsorted(base_ids, ids, sorter=order), len(base_ids) - 1)]
+    return np.where(base_ids[idx] == ids, idx, -1)
+
+
+def _changed_rows(base_ids, ids, base_columns, columns):
+    idx = _match(base_ids, ids)
+    changed = idx < 0
+    old = ~changed
+    for base_column, column in zip(base_columns, columns):
+        differs = base_column[idx[old]] != column[old]
+        changed[old] |= differs.any(axis=1) if differs.ndim > 1 else differs
+    return np.flatnonzero(changed)
+
+
+def _changed_paths(base_paths, paths, ids):
+    changed = {tid: path for tid, path in paths.items() if base_paths.get(tid) != path}
+    ids = set(ids)
+    changed.update((tid, []) for tid in base_paths if tid in ids and tid not in paths)
+    return changed
+
+
+def make_delta(base, snap):
+    vision_cells = np.flatnonzero(snap.vision != base.vision)
+    border_cells = np.flatnonzero(snap.border != base.border)
+    troops = _changed_rows(
+        base.troop_ids,
+        snap.troop_ids,
+        (base.troop_positions, base.troop_health),
+        (snap.troop_positions, snap.troop_health),
+    )
+    cities = _changed_rows(base.city_ids, snap.city_ids, (base.city_owners,), (snap.city_owners,))
+    return Delta(
+        tick=snap.tick,
+        base_tick=base.tick,
+        vision_cells=vision_cells,
+        vision_values=snap.vision.flat[vision_cells],
+        border_cells=border_cells,
+        border_values=snap.border.flat[border_cells],
+        removed_troops=np.setdiff1d(base.troop_ids, snap.troop_ids),
+        troop_ids=snap.troop_ids[troops],
+        troop_owners=snap.troop_owners[troops],
+        troop_positions=snap.troop_positions[troops],
+        troop_health=snap.troop_health[troops],
+        city_ids=snap.city_ids[cities],
+        city_owners=snap.city_owners[cities],
+        city_positions=snap.city_positions[cities],
+        troop_paths=_changed_paths(base.troop_paths, snap.troop_paths, snap.troop_ids),
+        city_paths=_changed_paths(base.city_paths, snap.city_paths, snap.city_ids),
+    )
+
+
+def _merge_rows(base_ids, ids, base_columns, columns, removed=None):
+    # Rows of base that were neither replaced nor removed, followed by the new rows.
+    keep = ~np.isin(base_ids, ids)
+    if removed is not None:
+        keep &= ~np.isin(base_ids, removed)
+    merged = [np.concatenate((old[keep], new)) for old, new in zip(base_columns, columns)]
+    return np.concatenate((base_ids[keep], ids)), merged
+
+
+def _merge_paths(base_paths, paths, removed):
+    merged = {tid: path for tid, path in base_paths.items() if tid not in removed}
+    for tid, path in paths.items():
+        if path:
+            merged[tid] = path
+        else:
+            merged.pop(tid, None)
+    return merged
+
+
+def _apply_cells(levels, cells, values):
+    # Unchanged grids stay the same array, so receivers can skip rebuilding from them.
+    if not len(cells):
+        return levels
+    levels = levels.copy()
+    levels.flat[cells] = values
+    return levels
+
+
+def apply_delta(base, delta):
+    vision = _apply_cells(base.vision, delta.vision_cells, delta.vision_values)
+    border = _apply_cells(base.border, delta.border_cells, delta.border_values)
+    removed = delta.removed_troops.astype(base.troop_ids.dtype)
+    troop_ids, (troop_owners, troop_positions, troop_health) = _merge_rows(
+        base.troop_ids,
+        delta.troop_ids.astype(base.troop_ids.dtype),
+        (base.troop_owners, base.troop_positions, base.troop_health),
+        (delta.troop_owners, delta.troop_positions, delta.troop_health),
+        removed,
+    )
+    city_ids, (city_owners, city_positions) = _merge_rows(
+        base.city_ids,
+        delta.city_ids.astype(base.city_ids.dtype),
+        (base.city_owners, base.city_positions),
+        (delta.city_owners, delta.city_positions),
+    )
+    return Snapshot(
+        tick=delta.tick,
+        vision=vision,
+        border=border,
+        troop_ids=troop_ids,
+        troop_owners=troop_owners,
+        troop_positions=troop_positions,
+        troop_health=troop_health,
+        city_ids=city_ids,
+        city_owners=city_owners,
+        city_positions=city_positions,
+        grid_bits=base.grid_bits,
+        troop_paths=_merge_paths(base.troop_paths, delta.troop_paths, set(removed.tolist())),
+        city_paths=_merge_paths(base.city_paths, delta.city_paths, ()),
+    )
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, st):
+        try:
+            values = st.unpack_from(self.data, self.offset)
+        except struct.error as e:
+            raise ProtocolError("truncated message") from e
+        self.offset += st.size
+        return values
+
+    def array(self, dtype, count, shape=None):
+        try:
+            values = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset)
+        except ValueError as e:
+            raise ProtocolError("truncated message") from e
+        self.offset += values.nbytes
+        return values if shape is None else values.reshape(shape)
+
+    def bytes(self, size):
+        if self.offset + size > len(self.data):
+            raise ProtocolError("truncated message")
+        self.offset += size
+        return self.data[self.offset - size : self.offset]
+
+
+def _header(data, expected):
+    reader = _Reader(data)
+    magic, version, kind = reader.unpack(HEADER)
+    if magic != MAGIC:
+        raise ProtocolError("not a war of dots message")
+    if kind == REJECT:
+        raise ProtocolError(f"server only speaks protocol versions {list(data[HEADER.size :])}")
+    if kind != expected:
+        raise ProtocolError(f"expected message type {expected}, got {kind}")
+    return reader, version
+
+
+def _pack_troops(rows):
+    # rows is a Snapshot or a Delta; both carry the same troop and city columns.
+    return b"".join(
+        (
+            np.asarray(rows.troop_ids, dtype="<u4").tobytes(),
+            np.asarray(rows.troop_owners, dtype="u1").tobytes(),
+            np.asarray(rows.troop_positions, dtype="<f4").tobytes(),
+            np.asarray(rows.troop_health, dtype="<f4").tobytes(),
+        )
+    )
+
+
+def _unpack_troops(reader, count):
+    return (
+        reader.array("<u4", count),
+        reader.array("u1", count),
+        reader.array("<f4", 2 * count, (count, 2)),
+        reader.array("<f4", count),
+    )
+
+
+def _pack_cities(rows):
+    return b"".join(
+        (
+            np.asarray(rows.city_ids, dtype="<u4").tobytes(),
+            np.asarray(rows.city_owners, dtype="i1").tobytes(),
+            np.asarray(rows.city_positions, dtype="<f4").tobytes(),
+        )
+    )
+
+
+def _unpack_cities(reader, count):
+    return (
+        reader.array("<u4", count),
+        reader.array("i1", count),
+        reader.array("<f4", 2 * count, (count, 2)),
+    )
+
+
+def _pack_grid(payload):
+    # Grid payloads are levels or changed cells; most of either compresses well.
+    packed = zlib.compress(payload, 1)
+    if len(packed) < len(payload):
+        return GRID_HEAD.pack(GRID_ZLIB, len(packed)) + packed
+    return GRID_HEAD.pack(0, len(payload)) + payload
+
+
+def _unpack_grid(reader):
+    flags, size = reader.unpack(GRID_HEAD)
+    payload = reader.bytes(size)
+    if flags & GRID_ZLIB:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error as e:
+            raise ProtocolError("bad grid payload") from e
+    return payload
+
+
+def _pack_levels(levels):
+    return _pack_grid(np.ascontiguousarray(levels, dtype=np.uint8).tobytes())
+
+
+def _unpack_levels(reader):
+    payload = _unpack_grid(reader)
+    if len(payload) != GRID_SIZE:
+        raise ProtocolError("bad grid size")
+    return np.frombuffer(payload, dtype=np.uint8).reshape(GRID_SHAPE)
+
+
+def _pack_cells(cells, values):
+    if not len(cells):
+        return GRID_HEAD.pack(0, 0)
+    return _pack_grid(
+        np.asarray(cells, dtype="<u2").tobytes() + np.asarray(values, dtype=np.uint8).tobytes()
+    )
+
+
+def _unpack_cells(reader):
+    payload = _unpack_grid(reader)
+    count, extra = divmod(len(payload), 3)
+    cells = np.frombuffer(payload, dtype="<u2", count=count)
+    if extra or (count and cells.max() >= GRID_SIZE):
+        raise ProtocolError("bad grid cells")
+    return cells, np.frombuffer(payload, dtype=np.uint8, count=count, offset=2 * count)
+
+
+def _pack_paths(paths):
+    ids = np.fromiter(paths.keys(), dtype="<u4", count=len(paths))
+    lengths = np.fromiter((len(points) for points in paths.values()), dtype="<u4", count=len(paths))
+    points = np.array([point for points in paths.values() for point in points], dtype="<f4")
+    return COUNT.pack(len(paths)) + ids.tobytes() + lengths.tobytes() + points.tobytes()
+
+
+def _unpack_paths(reader):
+    (count,) = reader.unpack(COUNT)
+    ids = reader.array("<u4", count)
+    lengths = reader.array("<u4", count)
+    points = reader.array("<f4", 2 * int(lengths.sum()), (-1, 2))
+    splits = np.split(points, np.cumsum(lengths)[:-1]) if count else []
+    return {tid: path.tolist() for tid, path in zip(ids.tolist(), splits)}
+
+
+def encode_hello(versions=VERSIONS):
+    return HEADER.pack(MAGIC, max(versions), HELLO) + bytes([len(versions), *versions])
+
+
+def negotiate(data):
+    # Highest version both ends speak, or None if there is none or data is not a hello.
+    try:
+        reader, _ = _header(data, HELLO)
+        (count,) = reader.unpack(BYTE)
+        offered = reader.array("u1", count).tolist()
+    except ProtocolError:
+        return None
+    common = set(offered) & set(VERSIONS)
+    return max(common) if common else None
+
+
+def encode_reject():
+    return HEADER.pack(MAGIC, max(VERSIONS), REJECT) + bytes(VERSIONS)
+
+
+def encode_welcome(version, player_num, players, terrain, forest, city_positions):
+    return (
+        HEADER.pack(MAGIC, version, WELCOME)
+        + WELCOME_HEAD.pack(player_num, players, len(city_positions))
+        + np.asarray(terrain, dtype="<f4").tobytes()
+        + np.asarray(forest, dtype="<f4").tobytes()
+        + np.asarray(city_positions, dtype="<f4").tobytes()
+    )
+
+
+def decode_welcome(data):
+    reader, version = _header(data, WELCOME)
+    player_num, players, cities = reader.unpack(WELCOME_HEAD)
+    terrain = reader.array("<f4", GRID_SIZE, GRID_SHAPE)
+    forest = reader.array("<f4", GRID_SIZE, GRID_SHAPE)
+    city_positions = reader.array("<f4", 2 * cities, (cities, 2))
+    return version, player_num, players, terrain, forest, city_positions
+
+
+def encode_snapshot(version, snap):
+    return b"".join(
+        (
+            HEADER.pack(MAGIC, version, SNAPSHOT),
+            SNAPSHOT_HEAD.pack(snap.tick, snap.grid_bits, len(snap.troop_ids), len(snap.city_ids)),
+            _pack_levels(snap.vision),
+            _pack_levels(snap.border),
+            _pack_troops(snap),
+            _pack_cities(snap),
+            _pack_paths(snap.troop_paths),
+            _pack_paths(snap.city_paths),
+        )
+    )
+
+
+def decode_snapshot(data):
+    reader, _ = _header(data, SNAPSHOT)
+    tick, grid_bits, troops, cities = reader.unpack(SNAPSHOT_HEAD)
+    vision = _unpack_levels(reader)
+    border = _unpack_levels(reader)
+    troop_ids, troop_owners, troop_positions, troop_health = _unpack_troops(reader, troops)
+    city_ids, city_owners, city_positions = _unpack_cities(reader, cities)
+    return Snapshot(
+        tick,
+        vision,
+        border,
+        troop_ids,
+        troop_owners,
+        troop_positions,
+        troop_health,
+        city_ids,
+        city_owners,
+        city_positions,
+        grid_bits,
+        troop_paths=_unpack_paths(reader),
+        city_paths=_unpack_paths(reader),
+    )
+
+
+def encode_delta(version, delta):
+    return b"".join(
+        (
+            HEADER.pack(MAGIC, version, DELTA),
+            DELTA_HEAD.pack(
+                delta.tick,
+                delta.base_tick,
+                len(delta.removed_troops),
+                len(delta.troop_ids),
+                len(delta.city_ids),
+            ),
+            _pack_cells(delta.vision_cells, delta.vision_values),
+            _pack_cells(delta.border_cells, delta.border_values),
+            np.asarray(delta.removed_troops, dtype="<u4").tobytes(),
+            _pack_troops(delta),
+            _pack_cities(delta),
+            _pack_paths(delta.troop_paths),
+            _pack_paths(delta.city_paths),
+        )
+    )
+
+
+def decode_delta(data):
+    reader, _ = _header(data, DELTA)
+    tick, base_tick, removed, troops, cities = reader.unpack(DELTA_HEAD)
+    vision_cells, vision_values = _unpack_cells(reader)
+    border_cells, border_values = _unpack_cells(reader)
+    removed_troops = reader.array("<u4", removed)
+    troop_ids, troop_owners, troop_positions, troop_health = _unpack_troops(reader, troops)
+    city_ids, city_owners, city_positions = _unpack_cities(reader, cities)
+    return Delta(
+        tick,
+        base_tick,
+        vision_cells,
+        vision_values,
+        border_cells,
+        border_values,
+        removed_troops,
+        troop_ids,
+        troop_owners,
+        troop_positions,
+        troop_health,
+        city_ids,
+        city_owners,
+        city_positions,
+        troop_paths=_unpack_paths(reader),
+        city_paths=_unpack_paths(reader),
+    )
+
+
+def decode_update(data, history):
+    # A snapshot, or a delta applied to the snapshot in history it was made against.
+    if data[HEADER.size - 1 : HEADER.size] != bytes([DELTA]):
+        return decode_snapshot(data)
+    delta = decode_delta(data)
+    base = history.get(delta.base_tick)
+    if base is None:
+        raise ProtocolError(f"delta against unknown tick {delta.base_tick}")
+    return apply_delta(base, delta)
+
+
+def encode_input(version, player_input, ack):
+    # player_input is a command from COMMANDS or [troop orders, city orders], each a list
+    # of (entity ID, path) pairs as the client builds them.
+    message = HEADER.pack(MAGIC, version, INPUT) + ACK.pack(ack)
+    if isinstance(player_input, str):
+        return message + BYTE.pack(COMMANDS.index(player_input))
+    troop_orders, city_orders = player_input
+    return message + BYTE.pack(0) + _pack_paths(dict(troop_orders)) + _pack_paths(dict(city_orders))
+
+
+def decode_input(data):
+    # Returns (acknowledged tick, player input).
+    reader, _ = _header(data, INPUT)
+    (ack,) = reader.unpack(ACK)
+    (command,) = reader.unpack(BYTE)
+    if command >= len(COMMANDS):
+        raise ProtocolError(f"unknown command {command}")
+    if command:
+        return ack, COMMANDS[command]
+    troop_orders = _unpack_paths(reader)
+    city_orders = _unpack_paths(reader)
+    return ack, [list(troop_orders.items()), list(city_orders.items())]
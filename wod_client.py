@@ -1,173 +1,566 @@
-import json
+import threading
+import time
+from collections import OrderedDict
 
+import numpy as np
 import pygame
 
 import simple_socket
-from constants import (
-    CELL_SIZE,
-    COLORS,
-    COLS,
-    PORTS,
-    ROWS,
-    TABLE,
-    TERRAIN_VALUES,
-    THRESHOLD,
-    WORLD_X,
-    WORLD_Y,
-)
+import wire
+from constants import CELL_SIZE, COLORS, PORTS, TABLE, TERRAIN_VALUES, THRESHOLD, WORLD_X, WORLD_Y
+
+# Segment end points per case, as indices into (p_top, p_right, p_bottom, p_left); -1 pads.
+SEGMENTS = np.full((16, 2, 2), -1)
+for case, pairs in {
+    1: [(3, 0)],
+    2: [(0, 1)],
+    3: [(3, 1)],
+    4: [(1, 2)],
+    5: [(3, 0), (1, 2)],
+    6: [(0, 2)],
+    7: [(3, 2)],
+    8: [(2, 3)],
+    9: [(0, 2)],
+    10: [(0, 1), (2, 3)],
+    11: [(1, 2)],
+    12: [(1, 3)],
+    13: [(0, 1)],
+    14: [(3, 0)],
+}.items():
+    SEGMENTS[case, : len(pairs)] = pairs
+
+POINT_NAMES = ("v0", "v1", "v2", "v3", "p_top", "p_right", "p_bottom", "p_left")
+# Polygon corners per case, as indices into POINT_NAMES; up to two polygons of five, -1 pads.
+POLYGONS = np.full((16, 2, 5), -1)
+for case, specs in {15: [["v0", "v1", "v2", "v3"]], **TABLE}.items():
+    for k, spec in enumerate(specs):
+        POLYGONS[case, k, : len(spec)] = [POINT_NAMES.index(name) for name in spec]
 
 
 def interp(threshold, a, b):
-    if a == b:
-        return 0.5
-    t = (threshold - a) / (b - a)
-    return max(0.0, min(1.0, t))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (threshold - a) / (b - a)
+    return np.where(a == b, 0.5, np.clip(t, 0.0, 1.0))
 
 
-def marching_squares(grid, cell_size, rows, cols, threshold):
-    segments = []
+def cell_index(grid, cells=None):
+    # Row and column of each cell, numbered row-major; all cells when none are given.
+    rows, cols = np.shape(grid)
+    if cells is None:
+        cells = np.arange((rows - 1) * (cols - 1))
+    return np.divmod(cells, cols - 1)
+
+
+def cell_corners(grid, row, col):
+    # Values at each cell's (row, col), (row, col + 1), (row + 1, col + 1), (row + 1, col).
+    g = np.asarray(grid, dtype=np.float64)
+    return g[row, col], g[row, col + 1], g[row + 1, col + 1], g[row + 1, col]
+
+
+def cell_cases(threshold, corners):
+    # Bit i of a cell's case is set when its corner i is above threshold.
+    bits = [(corner > threshold).astype(np.intp) << i for i, corner in enumerate(corners)]
+    return bits[0] | bits[1] | bits[2] | bits[3]
+
+
+def segment_cells(grid, cell_size, threshold, cells=None):
+    # Border segments per cell as an (n, 2, 2, 2) array, and which of the two are present.
     cs = cell_size
-    for j in range(rows):
-        for i in range(cols):
-            c0 = grid[j][i]
-            c3 = grid[j][i + 1]
-            c2 = grid[j + 1][i + 1]
-            c1 = grid[j + 1][i]
-
-            p_top = interp(threshold, c0, c1)
-            p_right = interp(threshold, c1, c2)
-            p_bottom = interp(threshold, c3, c2)
-            p_left = interp(threshold, c0, c3)
-
-            x = j * cs
-            y = i * cs
-            p0 = (x + p_top * cs, y)
-            p1 = (x + cs, y + p_right * cs)
-            p2 = (x + p_bottom * cs, y + cs)
-            p3 = (x, y + p_left * cs)
-            idx = 0
-            if c0 > threshold:
-                idx |= 1
-            if c1 > threshold:
-                idx |= 2
-            if c2 > threshold:
-                idx |= 4
-            if c3 > threshold:
-                idx |= 8
-            if idx == 0 or idx == 15:
-                pass
-            elif idx == 1:
-                segments.append((p3, p0))
-            elif idx == 2:
-                segments.append((p0, p1))
-            elif idx == 3:
-                segments.append((p3, p1))
-            elif idx == 4:
-                segments.append((p1, p2))
-            elif idx == 5:
-                segments.append((p3, p0))
-                segments.append((p1, p2))
-            elif idx == 6:
-                segments.append((p0, p2))
-            elif idx == 7:
-                segments.append((p3, p2))
-            elif idx == 8:
-                segments.append((p2, p3))
-            elif idx == 9:
-                segments.append((p0, p2))
-            elif idx == 10:
-                segments.append((p0, p1))
-                segments.append((p2, p3))
-            elif idx == 11:
-                segments.append((p1, p2))
-            elif idx == 12:
-                segments.append((p1, p3))
-            elif idx == 13:
-                segments.append((p0, p1))
-            elif idx == 14:
-                segments.append((p3, p0))
-    return segments
-
-
-def marching_squares_poly(grid, cell_size, rows, cols, threshold):
-    polys = []
+    row, col = cell_index(grid, cells)
+    g00, g01, g11, g10 = cell_corners(grid, row, col)
+    x, y = row * float(cs), col * float(cs)
+    points = np.stack(
+        (
+            np.stack((x + interp(threshold, g00, g10) * cs, y), axis=-1),
+            np.stack((x + cs, y + interp(threshold, g10, g11) * cs), axis=-1),
+            np.stack((x + interp(threshold, g01, g11) * cs, y + cs), axis=-1),
+            np.stack((x, y + interp(threshold, g00, g01) * cs), axis=-1),
+        ),
+        axis=-2,
+    )
+    ends = SEGMENTS[cell_cases(threshold, (g00, g10, g11, g01))]
+    segments = points[np.arange(len(row))[:, None, None], np.maximum(ends, 0)]
+    return segments, ends[:, :, 0] >= 0
+
+
+def polygon_cells(grid, cell_size, threshold, cells=None):
+    # Filled polygons per cell from TABLE as an (n, 2, 5, 2) array, and which vertices are
+    # kept: padding and repeats of the previous vertex drop out, so polygons can shrink.
     cs = cell_size
-    thr = threshold
-
-    for i in range(rows):
-        for j in range(cols):
-            c0 = grid[i][j]
-            c1 = grid[i][j + 1]
-            c2 = grid[i + 1][j + 1]
-            c3 = grid[i + 1][j]
-
-            row_pos = i * cs
-            col_pos = j * cs
-
-            v0 = (row_pos, col_pos)
-            v1 = (row_pos, col_pos + cs)
-            v2 = (row_pos + cs, col_pos + cs)
-            v3 = (row_pos + cs, col_pos)
-
-            p_top = (row_pos, col_pos + interp(threshold, c0, c1) * cs)
-            p_right = (row_pos + interp(threshold, c1, c2) * cs, col_pos + cs)
-            p_bottom = (row_pos + cs, col_pos + interp(threshold, c3, c2) * cs)
-            p_left = (row_pos + interp(threshold, c0, c3) * cs, col_pos)
-
-            inside = [c0 > thr, c1 > thr, c2 > thr, c3 > thr]
-            idx = 0
-            if inside[0]:
-                idx |= 1
-            if inside[1]:
-                idx |= 2
-            if inside[2]:
-                idx |= 4
-            if inside[3]:
-                idx |= 8
-
-            if idx == 0:
-                continue
-            if idx == 15:
-                polys.append([v0, v1, v2, v3])
-                continue
-
-            pts = {
-                "v0": v0,
-                "v1": v1,
-                "v2": v2,
-                "v3": v3,
-                "p_top": p_top,
-                "p_right": p_right,
-                "p_bottom": p_bottom,
-                "p_left": p_left,
-            }
-
-            specs = TABLE.get(idx, [])
-            for spec in specs:
-                poly = [pts[name] for name in spec]
-                compact = []
-                for p in poly:
-                    if not compact or (
-                        abs(p[0] - compact[-1][0]) > 1e-9 or abs(p[1] - compact[-1][1]) > 1e-9
-                    ):
-                        compact.append(p)
-                if len(compact) >= 3:
-                    polys.append(compact)
-
-    return polys
-
-
-def marching_squares_layers(grid, cell_size, rows, cols, thresholds):
-    layers = []
-    for thr in thresholds:
-        threshold = thr
-        polys = marching_squares_poly(grid, cell_size, rows, cols, threshold)
-        layers.append(polys)
-    return layers
+    row, col = cell_index(grid, cells)
+    g00, g01, g11, g10 = cell_corners(grid, row, col)
+    x, y = row * float(cs), col * float(cs)
+    points = np.stack(
+        (
+            np.stack((x, y), axis=-1),
+            np.stack((x, y + cs), axis=-1),
+            np.stack((x + cs, y + cs), axis=-1),
+            np.stack((x + cs, y), axis=-1),
+            np.stack((x, y + interp(threshold, g00, g01) * cs), axis=-1),
+            np.stack((x + interp(threshold, g01, g11) * cs, y + cs), axis=-1),
+            np.stack((x + cs, y + interp(threshold, g10, g11) * cs), axis=-1),
+            np.stack((x + interp(threshold, g00, g10) * cs, y), axis=-1),
+        ),
+        axis=-2,
+    )
+    spec = POLYGONS[cell_cases(threshold, (g00, g01, g11, g10))]
+    polys = points[np.arange(len(row))[:, None, None], np.maximum(spec, 0)]
+    kept = spec >= 0
+    kept[:, :, 1:] &= (np.abs(polys[:, :, 1:] - polys[:, :, :-1]) > 1e-9).any(axis=-1)
+    return polys, kept
+
+
+def select_segments(segments, present):
+    return segments[present]
+
+
+def group_polygons(polys, kept):
+    # One (n, k, 2) array per vertex count k, skipping polygons left with fewer than three.
+    polys = polys.reshape(-1, 5, 2)
+    kept = kept.reshape(-1, 5)
+    sizes = kept.sum(axis=1)
+    groups = []
+    for size in np.unique(sizes[sizes >= 3]).tolist():
+        rows = sizes == size
+        groups.append(polys[rows][kept[rows]].reshape(-1, size, 2))
+    return groups
+
+
+def marching_squares(grid, cell_size, threshold):
+    # Border line segments for the whole grid as an (n, 2, 2) array, in cell order.
+    return select_segments(*segment_cells(grid, cell_size, threshold))
+
+
+def marching_squares_poly(grid, cell_size, threshold):
+    return group_polygons(*polygon_cells(grid, cell_size, threshold))
+
+
+class ContourCache:
+    # Contours of a grid that mostly stays the same from one frame to the next.  A cell is
+    # only marched again when one of its corners changed and it was or is now mixed, since
+    # the contour through a cell entirely above or below the threshold doesn't depend on
+    # the corner values.  The per-cell results are patched in place.
+    def __init__(self, cell_size, threshold, polygons=False):
+        self.cell_size = cell_size
+        self.threshold = threshold
+        self.march, self.select = (
+            (polygon_cells, group_polygons) if polygons else (segment_cells, select_segments)
+        )
+        self.source = self.grid = None
+        self.dirty = np.arange(0)
+
+    def update(self, grid):
+        # The same grid object as last time (grid_view hands back its cached one) has the
+        # same contours; compared before the conversion, which copies anything not float64.
+        if grid is self.source:
+            self.dirty = self.dirty[:0]
+            return self.contours
+        self.source = grid
+        grid = np.asarray(grid, dtype=np.float64)
+        if self.grid is None or self.grid.shape != grid.shape:
+            self.cells = self.march(grid, self.cell_size, self.threshold)
+            self.above = self.corners_above(grid)
+            self.dirty = np.arange(len(self.above))
+        else:
+            changed = grid != self.grid
+            touched = changed[:-1, :-1] | changed[:-1, 1:] | changed[1:, 1:] | changed[1:, :-1]
+            cells = np.flatnonzero(touched)
+            above = self.corners_above(grid, cells)
+            self.dirty = cells[(above != self.above[cells]) | (above % 4 != 0)]
+            self.above[cells] = above
+            if len(self.dirty):
+                patch = self.march(grid, self.cell_size, self.threshold, self.dirty)
+                for whole, part in zip(self.cells, patch):
+                    whole[self.dirty] = part
+        if len(self.dirty):
+            self.contours = self.select(*self.cells)
+        self.grid = grid
+        return self.contours
+
+    def corners_above(self, grid, cells=None):
+        corners = cell_corners(grid, *cell_index(grid, cells))
+        above = [(corner > self.threshold).astype(np.int8) for corner in corners]
+        return above[0] + above[1] + above[2] + above[3]
+
+
+def marching_squares_layers(grid, cell_size, thresholds):
+    return [marching_squares_poly(grid, cell_size, thr) for thr in thresholds]
+
+
+def fog_alpha(grid, threshold, softness):
+    # Fog opacity in [0, 1] per grid point: a smoothstep across threshold +/- softness.
+    t = np.clip((np.asarray(grid) - threshold) / (2 * softness) + 0.5, 0.0, 1.0)
+    return t * t * (3 - 2 * t)
+
+
+class RasterFog:
+    # Fog as an image with one pixel per vision grid point, smoothscaled onto the screen in
+    # one blit, so its cost doesn't depend on how ragged the edge of the fog is.  Only the
+    # grid points in view are scaled, and the result is kept until the grid, zoom or the
+    # visible part of the grid changes.
+    def __init__(self, cell_size, threshold, color=(0, 0, 0), alpha=150, softness=0.1):
+        self.cell_size = cell_size
+        self.threshold = threshold
+        self.color = color
+        self.alpha = alpha
+        self.softness = softness
+        self.grid = None
+        self.key = None
+
+    def render(self, grid, zoom, camera, size):
+        # The scaled fog for a screen of the given size, and where on the screen it goes.
+        if grid is not self.grid:
+            image = pygame.Surface(np.shape(grid), pygame.SRCALPHA)
+            image.fill(self.color)
+            opacity = fog_alpha(grid, self.threshold, self.softness) * self.alpha
+            pygame.surfarray.pixels_alpha(image)[...] = opacity.astype(np.uint8)
+            self.image = image
+            self.grid = grid
+            self.key = None
+        # Pixel i is centred on grid point i, which sits at world coordinate i * cell_size.
+        cs = self.cell_size
+        first = [max(0, int(cam / cs + 0.5)) for cam in camera]
+        last = [
+            min(n, int((cam + extent / zoom) / cs + 0.5) + 1)
+            for cam, extent, n in zip(camera, size, np.shape(grid))
+        ]
+        key = (zoom, *first, *last)
+        if key != self.key:
+            rect = pygame.Rect(first, (last[0] - first[0], last[1] - first[1]))
+            scaled = (round(rect.w * cs * zoom), round(rect.h * cs * zoom))
+            self.scaled = pygame.transform.smoothscale(self.image.subsurface(rect), scaled)
+            self.key = key
+        position = [round(((i - 0.5) * cs - cam) * zoom) for i, cam in zip(first, camera)]
+        return self.scaled, position
+
+
+class TerrainTiles:
+    # The terrain drawn on demand in square tiles for each zoom level.  Tiles are kept in
+    # least recently used order and the oldest dropped once they go over the memory budget.
+    def __init__(self, layers, cities, tile_size=256, budget=64 << 20):
+        # layers is a list of (color, polygons) drawn in order, as from marching_squares_poly.
+        self.polygons = [
+            (color, group, group.min(axis=1), group.max(axis=1))
+            for color, polygons in layers
+            for group in polygons
+        ]
+        self.extent = max((high - low).max() for _, _, low, high in self.polygons)
+        self.cities = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+        self.tile_size = tile_size
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.used = 0
+
+    def world_size(self, zoom):
+        return max(1, int(WORLD_X * zoom)), max(1, int(WORLD_Y * zoom))
+
+    def tile(self, zoom, tx, ty):
+        key = (zoom, tx, ty)
+        surf = self.tiles.get(key)
+        if surf is not None:
+            self.tiles.move_to_end(key)
+            return surf
+        surf = self.tiles[key] = self.render(zoom, tx, ty)
+        self.used += surf.get_width() * surf.get_height() * surf.get_bytesize()
+        while self.used > self.budget and len(self.tiles) > 1:
+            _, old = self.tiles.popitem(last=False)
+            self.used -= old.get_width() * old.get_height() * old.get_bytesize()
+        return surf
+
+    def render(self, zoom, tx, ty):
+        ts = self.tile_size
+        world = self.world_size(zoom)
+        size = (min(ts, world[0] - tx * ts), min(ts, world[1] - ty * ts))
+        # pygame rounds polygon edges at negative coordinates differently, so the tile is drawn
+        # with a margin wider than any polygon around it and cut out afterwards.
+        margin = int(self.extent * zoom) + 2
+        origin = np.array((tx * ts - margin, ty * ts - margin))
+        surf = pygame.Surface((size[0] + 2 * margin, size[1] + 2 * margin), pygame.SRCALPHA)
+        # World coordinates the tile covers, with a pixel to spare for rounding.
+        low = (origin + margin - 1) / zoom
+        high = (origin + margin + size + 1) / zoom
+        for color, group, poly_low, poly_high in self.polygons:
+            near = ((poly_high >= low) & (poly_low <= high)).all(axis=1)
+            for poly in ((group[near] * zoom).astype(int) - origin).tolist():
+                pygame.draw.polygon(surf, color, poly, 0)
+        for position in self.cities.tolist():
+            cx, cy = int(position[0] * zoom) - origin[0], int(position[1] * zoom) - origin[1]
+            pygame.draw.circle(surf, (255, 215, 0), (cx, cy), max(1, int(15 * zoom)))
+        return surf.subsurface((margin, margin), size).copy()
+
+    def blit(self, screen, zoom, offset):
+        # Draws the tiles in view with the world's top left corner at offset on the screen.
+        ts = self.tile_size
+        world = self.world_size(zoom)
+        width, height = screen.get_size()
+        for tx in range(max(0, -offset[0] // ts), (min(world[0], width - offset[0]) - 1) // ts + 1):
+            for ty in range(
+                max(0, -offset[1] // ts), (min(world[1], height - offset[1]) - 1) // ts + 1
+            ):
+                screen.blit(self.tile(zoom, tx, ty), (offset[0] + tx * ts, offset[1] + ty * ts))
+
+
+class SpatialIndex:
+    # Points bucketed into square cells, to find those near a point without looking at all.
+    def __init__(self, positions, cell_size=64):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = cell_size
+        self.cells = {}
+        cells = np.floor(self.positions / cell_size).astype(int).tolist()
+        for i, cell in enumerate(cells):
+            self.cells.setdefault(tuple(cell), []).append(i)
+
+    def near(self, point, radius):
+        # Indices of the points within radius of point.
+        (x0, y0), (x1, y1) = np.floor(
+            (np.asarray(point) + [[-radius], [radius]]) / self.cell_size
+        ).astype(int)
+        found = [
+            i
+            for cx in range(x0, x1 + 1)
+            for cy in range(y0, y1 + 1)
+            for i in self.cells.get((cx, cy), ())
+        ]
+        found = np.array(found, dtype=int)
+        d2 = ((self.positions[found] - point) ** 2).sum(axis=1)
+        return found[d2 <= radius * radius]
+
+
+class Overlay:
+    # A transparent screen-sized surface kept across frames.  Everything drawn on it goes
+    # through draw() so that only those rects need clearing for the next frame, and
+    # segments and polygons entirely off the surface are skipped.
+    def __init__(self, size):
+        self.surface = pygame.Surface(size, pygame.SRCALPHA)
+        self.drawn = []
+
+    def clear(self):
+        for rect in self.drawn:
+            self.surface.fill((0, 0, 0, 0), rect)
+        self.drawn = []
+
+    def draw(self, draw, *args):
+        rect = draw(self.surface, *args)
+        self.drawn.append(rect)
+        return rect
+
+    def visible(self, points, margin):
+        # Which of the (n, k, 2) screen point groups have a bounding box on the surface.
+        low = points.min(axis=1) - margin
+        high = points.max(axis=1) + margin
+        return ((high >= 0) & (low < self.surface.get_size())).all(axis=1)
+
+    def segments(self, color, segments, width):
+        segments = np.asarray(segments).reshape(-1, 2, 2)
+        for a, b in segments[self.visible(segments, width)].tolist():
+            self.draw(pygame.draw.line, color, a, b, width)
+
+    def lines(self, color, points, width):
+        points = np.asarray(points).reshape(-1, 2)
+        self.segments(color, np.stack((points[:-1], points[1:]), axis=1), width)
+
+    def blits(self, blits):
+        drawn = self.surface.blits(blits)
+        if drawn is not None:
+            self.drawn.extend(drawn)
+
+    def blit_to(self, screen):
+        if self.drawn:
+            area = self.drawn[0].unionall(self.drawn[1:])
+            screen.blit(self.surface, area, area)
+
+    def polygons(self, color, polygons):
+        for group in polygons:
+            for poly in group[self.visible(group, 1)].tolist():
+                self.draw(pygame.draw.polygon, color, poly, 0)
+
+
+class Receiver(threading.Thread):
+    # Reads and decodes updates from the server as they arrive and keeps only the newest for
+    # the render loop to take.  The server pushes updates on its own schedule; orders and
+    # commands go the other way as they happen, with a heartbeat in between that tells the
+    # server which update the client has, for it to make deltas against.
+    def __init__(self, client, version):
+        super().__init__(daemon=True)
+        self.client = client
+        self.version = version
+        self.snapshots = wire.History()
+        self.ready = threading.Condition()
+        self.latest = None
+        self.running = True
+        self.sending = threading.Lock()
+        self.acked = None
+        self.sent = 0.0
+
+    def run(self):
+        try:
+            while True:
+                data = self.client.rcv()
+                if not data:
+                    break
+                snap = wire.decode_update(data, self.snapshots)
+                self.snapshots.add(snap)
+                self.acked = snap.tick
+                with self.ready:
+                    self.latest = (snap, time.perf_counter())
+                    self.ready.notify_all()
+        except (wire.ProtocolError, OSError) as e:
+            print("connection lost:", e)
+        finally:
+            with self.ready:
+                self.running = False
+                self.ready.notify_all()
+
+    def take(self, timeout: float | None = 0):
+        # The newest update that hasn't been taken yet and when it arrived, waiting up to
+        # timeout seconds (or for good with None) for one; None if there is none.
+        with self.ready:
+            self.ready.wait_for(lambda: self.latest is not None or not self.running, timeout)
+            latest, self.latest = self.latest, None
+        return latest
+
+    def send(self, player_input):
+        # Called from the render loop once the first update is in.  A broken connection is
+        # left for run() to notice.
+        with self.sending:
+            message = wire.encode_input(self.version, player_input, self.acked)
+            try:
+                self.client.send(message)
+            except OSError:
+                pass
+            self.sent = time.perf_counter()
+
+    def heartbeat(self):
+        if time.perf_counter() - self.sent >= wire.HEARTBEAT:
+            self.send([[], []])
+
+
+class Interpolator:
+    # Smooths troop movement between snapshots.  When a snapshot arrives its troops move from
+    # where they were last drawn to where it has them over one snapshot interval, timed by
+    # the ticks between the snapshots.  If the next snapshot is late they keep going at the
+    # same speed for at most max_extrapolation intervals more.
+    def __init__(self, max_extrapolation=0.5, smoothing=0.1):
+        self.max_extrapolation = max_extrapolation
+        self.smoothing = smoothing
+        self.current = None
+        self.start = None
+        self.arrived = 0.0
+        self.interval = 0.0
+        self.tick_time = None
+
+    def add(self, snap, arrived):
+        current = self.current
+        if current is not None and snap.tick <= current.tick:
+            # A repeat or a straggler leaves the movement under way alone; only a same tick
+            # snapshot with other troops in it, such as a rebuilt keyframe, takes over.
+            same = np.array_equal(snap.troop_ids, current.troop_ids) and np.array_equal(
+                snap.troop_positions, current.troop_positions
+            )
+            if snap.tick == current.tick and not same:
+                self.start = self.matched(current, snap, self.start)
+                self.current = snap
+            return
+        positions = snap.troop_positions.astype(np.float64)
+        interval = 0.0
+        if current is not None:
+            # Troops start from where they are drawn now.
+            positions = self.matched(current, snap, self.positions(arrived))
+
+            ticks = snap.tick - current.tick
+            elapsed = (arrived - self.arrived) / ticks
+            if self.tick_time is None:
+                self.tick_time = elapsed
+            else:
+                self.tick_time += self.smoothing * (elapsed - self.tick_time)
+            interval = ticks * self.tick_time
+        self.current = snap
+        self.interval = interval
+        self.start = positions
+        self.arrived = arrived
+
+    def matched(self, current, snap, rows):
+        # rows, one per troop of current, put in snap's troop order by id; troops new in
+        # snap get their positions in it.
+        positions = snap.troop_positions.astype(np.float64)
+        order = np.argsort(current.troop_ids)
+        ids = current.troop_ids[order]
+        at = np.minimum(np.searchsorted(ids, snap.troop_ids), max(0, len(ids) - 1))
+        found = ids[at] == snap.troop_ids if len(ids) else np.zeros(len(positions), bool)
+        positions[found] = rows[order[at[found]]]
+        return positions
+
+    def positions(self, now):
+        # Where to draw the current snapshot's troops at time now; none before the first.
+        snap = self.current
+        if snap is None:
+            return np.empty((0, 2))
+        if self.interval <= 0:
+            return snap.troop_positions
+        alpha = min(max(0.0, (now - self.arrived) / self.interval), 1 + self.max_extrapolation)
+        return self.start + (snap.troop_positions - self.start) * alpha
+
+
+def draw_troop(surface, center, zoom, color, health_width, selected):
+    # A troop's dot with a health bar health_width pixels long above it; returns the rects
+    # drawn on.
+    px, py = center
+    r = max(1, int(7 * zoom))
+    bar = max(1, int(3 * zoom))
+    if selected:
+        color = [max(0, min(255, int(x * 0.5))) for x in color]
+    health = pygame.rect.Rect(px - r, (py - r) - bar, health_width, bar)
+    return [
+        pygame.draw.rect(surface, (0, 255, 0), health),
+        pygame.draw.circle(surface, color, (px, py), r),
+    ]
+
+
+def draw_flag(surface, center, zoom, color):
+    # A city's flag on a pole standing on center; returns the rects drawn on.
+    px, py = center
+    pole_top = (px, int(py - 30 * zoom))
+    fw, fh = int(20 * zoom), int(14 * zoom)
+    flag = [pole_top, (pole_top[0] + fw, pole_top[1] + fh // 2), (pole_top[0], pole_top[1] + fh)]
+    return [
+        pygame.draw.line(surface, (80, 80, 80), center, pole_top, max(1, int(3 * zoom))),
+        pygame.draw.polygon(surface, color, flag),
+        pygame.draw.polygon(surface, (0, 0, 0), flag, max(1, int(1 * zoom))),
+    ]
+
+
+SPRITE_KEY = (255, 0, 255)  # Background of sprites; nothing is drawn in this colour.
+
+
+class SpriteCache:
+    # Troops and flags drawn once per look and then blitted.  A sprite is cut out of what
+    # draw(surface, center, *args) puts on a scratch surface reaching `reach` pixels around
+    # center, with a colour key for the background since keyed blits are a lot cheaper than
+    # per-pixel alpha ones.  Only the sprites for the current zoom level are kept.
+    def __init__(self):
+        self.zoom_idx = None
+        self.sprites = {}
+
+    def get(self, key, zoom_idx, reach, draw, *args):
+        # The sprite and the position of its center on it.
+        if zoom_idx != self.zoom_idx:
+            self.zoom_idx = zoom_idx
+            self.sprites = {}
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            size = 2 * reach + 1
+            scratch = pygame.Surface((size, size))
+            scratch.fill(SPRITE_KEY)
+            rects = draw(scratch, (reach, reach), *args)
+            area = rects[0].unionall(rects[1:]).clip(scratch.get_rect())
+            image = scratch.subsurface(area).copy()
+            image.set_colorkey(SPRITE_KEY, pygame.RLEACCEL)
+            sprite = self.sprites[key] = (image, (reach - area.x, reach - area.y))
+        return sprite
 
 
 class Game:
-    def __init__(self, title):
+    def __init__(self, title, fog="raster"):
         pygame.init()
         info_object = pygame.display.Info()
         desktop_width = info_object.current_w
@@ -200,6 +593,16 @@ class Game:
         self.pan_start_cam = (0.0, 0.0)
 
         self.draw_info = None
+        self.grid_views = {}
+        self.border_contours = ContourCache(CELL_SIZE, THRESHOLD)
+        self.fog_contours = ContourCache(CELL_SIZE, THRESHOLD, polygons=True)
+        self.raster_fog = RasterFog(CELL_SIZE, THRESHOLD)
+        self.fog_mode = fog
+        self.dynamic = Overlay(self.size)
+        self.fog = Overlay(self.size)
+        self.pick_indexes = {}
+        self.motion = Interpolator()
+        self.sprites = SpriteCache()
         self.player_input = [[], []]
         self.paths = []
         self.drawing_path = False
@@ -208,58 +611,52 @@ class Game:
 
         self.pause = False
 
-        self.terrain_by_zoom = {}
+        self.terrain = None
 
     def run_game(self):
         ip, port = input("ip\n: "), input("\nport\n: ")
         print("connecting...")
         self.client = simple_socket.Client(ip, PORTS[min(99, max(0, int(port)))])
         self.client.connect()
+        self.client.send(wire.encode_hello())
+        try:
+            welcome = wire.decode_welcome(self.client.rcv())
+        except wire.ProtocolError as e:
+            print("could not join:", e)
+            self.client.close()
+            pygame.quit()
+            return
+        self.version, self.player_num, _, terrain_grid, forrest_grid, cities = welcome
         print("connection successful!")
 
         print("drawing terrain...")
-        terrain_grid, forrest_grid, cities, self.player_num = json.loads(self.client.rcv())
         self.color = COLORS[self.player_num]
-        layers = marching_squares_layers(
-            terrain_grid, CELL_SIZE, ROWS, COLS, list(TERRAIN_VALUES.values())
-        )
-        layers.append(marching_squares_poly(forrest_grid, CELL_SIZE, ROWS, COLS, THRESHOLD))
-
-        for i in range(len(self.zoom_levels)):
-            z = self.get_zoom(i)
-            sw = max(1, int(WORLD_X * z))
-            sh = max(1, int(WORLD_Y * z))
-            surf = pygame.Surface((sw, sh), pygame.SRCALPHA)
-            for poly in layers[0]:
-                scaled = [(int(x * z), int(y * z)) for x, y in poly]
-                pygame.draw.polygon(surf, (0, 220, 255), scaled, 0)
-            for poly in layers[1]:
-                scaled = [(int(x * z), int(y * z)) for x, y in poly]
-                pygame.draw.polygon(surf, (20, 180, 20), scaled, 0)
-            for poly in layers[2]:
-                scaled = [(int(x * z), int(y * z)) for x, y in poly]
-                pygame.draw.polygon(surf, (150, 150, 150), scaled, 0)
-            for poly in layers[3]:
-                scaled = [(int(x * z), int(y * z)) for x, y in poly]
-                pygame.draw.polygon(surf, (100, 100, 100), scaled, 0)
-            for poly in layers[4]:
-                scaled = [(int(x * z), int(y * z)) for x, y in poly]
-                pygame.draw.polygon(surf, (30, 125, 30), scaled, 0)
-
-            for position in cities:
-                if position is None:
-                    continue
-                cx, cy = int(position[0] * z), int(position[1] * z)
-                pygame.draw.circle(surf, (255, 215, 0), (cx, cy), max(1, int(15 * z)))
-            self.terrain_by_zoom[z] = surf
+        layers = marching_squares_layers(terrain_grid, CELL_SIZE, list(TERRAIN_VALUES.values()))
+        layers.append(marching_squares_poly(forrest_grid, CELL_SIZE, THRESHOLD))
+        layer_colors = [
+            (0, 220, 255),
+            (20, 180, 20),
+            (150, 150, 150),
+            (100, 100, 100),
+            (30, 125, 30),
+        ]
+
+        self.terrain = TerrainTiles(list(zip(layer_colors, layers)), cities)
 
         print("terrain drawn! starting game (waiting for other players)...")
-        self.draw_info = json.loads(self.client.rcv())
+        self.receiver = Receiver(self.client, self.version)
+        self.receiver.start()
+        first = self.receiver.take(timeout=None)
+        self.done = first is None
+        if first is not None:
+            self.draw_info = first[0]
+            self.motion.add(*first)
         while not self.done:
             self.handle_events()
             self.draw()
             pygame.display.flip()
             self.clock.tick(30)
+        self.receiver.join(timeout=1)
         self.client.close()
         pygame.quit()
 
@@ -282,73 +679,16 @@ class Game:
                         self.zoom_out_at(e.pos)
 
                     elif e.button == 1:
-                        mx, my = e.pos[0], e.pos[1]
-                        troops = self.draw_info[2]
-
-                        r = max(1, int(7 * self.zoom))
-                        r3 = r * 3
-                        best = None
-                        best_dist2 = None
-                        best_pos = None
-                        for pos, color, tid, owner, path, health in troops:
-                            if owner == self.player_num:
-                                sx = int((pos[0] - self.camx) * self.zoom)
-                                sy = int((pos[1] - self.camy) * self.zoom)
-                                dx = (mx) - sx
-                                dy = (my) - sy
-                                d2 = dx * dx + dy * dy
-                                if d2 <= r3 * r3:
-                                    if best is None or d2 < best_dist2:
-                                        best_pos = pos
-                                        best = tid
-                                        best_dist2 = d2
-
+                        best, best_pos = self.pick("troop", e.pos)
                         if best is not None:
                             self.drawing_path = True
-
-                            wx = self.camx + mx / self.zoom
-                            wy = self.camy + my / self.zoom
-                            to_pop = None
-                            for i, id_path in enumerate(self.paths):
-                                if id_path[0] == best:
-                                    to_pop = i
-                            if to_pop is not None:
-                                self.paths.pop(to_pop)
+                            self.paths = [p for p in self.paths if p[0] != best]
                             self.paths.append((best, [best_pos]))
-
                         else:
-                            mx, my = e.pos[0], e.pos[1]
-                            cities = self.draw_info[3]
-
-                            r = max(1, int(7 * self.zoom))
-                            r3 = r * 3
-                            best_city = None
-                            best_dist2 = None
-                            best_pos = None
-                            for color, pos, cid, path, owner in cities:
-                                if owner == self.player_num:
-                                    sx = int((pos[0] - self.camx) * self.zoom)
-                                    sy = int((pos[1] - self.camy) * self.zoom)
-                                    dx = (mx) - sx
-                                    dy = (my) - sy
-                                    d2 = dx * dx + dy * dy
-                                    if d2 <= r3 * r3:
-                                        if best_city is None or d2 < best_dist2:
-                                            best_pos = pos
-                                            best_city = cid
-                                            best_dist2 = d2
-
+                            best_city, best_pos = self.pick("city", e.pos)
                             if best_city is not None:
                                 self.drawing_city_path = True
-
-                                wx = self.camx + mx / self.zoom
-                                wy = self.camy + my / self.zoom
-                                to_pop = None
-                                for i, id_path in enumerate(self.city_paths):
-                                    if id_path[0] == best_city:
-                                        to_pop = i
-                                if to_pop is not None:
-                                    self.city_paths.pop(to_pop)
+                                self.city_paths = [p for p in self.city_paths if p[0] != best_city]
                                 self.city_paths.append((best_city, [best_pos]))
 
                 elif e.type == pygame.MOUSEBUTTONUP:
@@ -415,6 +755,8 @@ class Game:
                     elif e.key == pygame.K_p:
                         self.player_input = "pause"
                         self.pause = True
+                    elif e.key == pygame.K_f:
+                        self.fog_mode = "polygon" if self.fog_mode == "raster" else "raster"
         else:
             for e in pygame.event.get():
                 if e.type == pygame.QUIT:
@@ -425,9 +767,20 @@ class Game:
                         self.player_input = "unpause"
                         self.pause = False
 
-        self.client.send(json.dumps(self.player_input, separators=(",", ":")))
+        if self.player_input != [[], []]:
+            self.receiver.send(self.player_input)
+        else:
+            self.receiver.heartbeat()
         self.player_input = [[], []]
 
+    def grid_view(self, name, levels, bits):
+        # The float grid is only rebuilt from the quantized levels when they change.
+        key = (wire.grid_hash(levels), bits)
+        cached = self.grid_views.get(name)
+        if cached is None or cached[0] != key:
+            cached = self.grid_views[name] = (key, wire.dequantize(levels, bits))
+        return cached[1]
+
     def zoom_in_at(self, screen_pos):
         if self.zoom_idx < len(self.zoom_levels) - 1:
             self.set_zoom_index(self.zoom_idx + 1, screen_pos)
@@ -465,127 +818,163 @@ class Game:
         if self.camy > max_camy:
             self.camy = max_camy
 
+    def pick(self, kind, pos):
+        # The player's troop or city ("troop" or "city") nearest to the screen position,
+        # within three troop radii, and its position.
+        snap = self.draw_info
+        if snap is None:
+            return None, None
+        if kind not in self.pick_indexes:
+            ids, owners, positions = (
+                (snap.troop_ids, snap.troop_owners, snap.troop_positions)
+                if kind == "troop"
+                else (snap.city_ids, snap.city_owners, snap.city_positions)
+            )
+            own = owners == self.player_num
+            self.pick_indexes[kind] = (
+                ids[own].tolist(),
+                positions[own].tolist(),
+                SpatialIndex(positions[own]),
+            )
+        ids, positions, index = self.pick_indexes[kind]
+
+        mx, my = pos
+        r3 = max(1, int(7 * self.zoom)) * 3
+        world = (self.camx + mx / self.zoom, self.camy + my / self.zoom)
+        best = None
+        best_dist2 = None
+        best_pos = None
+        for i in sorted(index.near(world, (r3 + 2) / self.zoom).tolist()):
+            sx = int((positions[i][0] - self.camx) * self.zoom)
+            sy = int((positions[i][1] - self.camy) * self.zoom)
+            d2 = (mx - sx) ** 2 + (my - sy) ** 2
+            if d2 <= r3 * r3 and (best is None or d2 < best_dist2):
+                best = ids[i]
+                best_dist2 = d2
+                best_pos = positions[i]
+        return best, best_pos
+
+    def sprite(self, key, center, draw, *args):
+        # The sprite for key and where to blit it to have its center on center.
+        reach = int(35 * self.zoom) + 4
+        image, (ax, ay) = self.sprites.get(key, self.zoom_idx, reach, draw, *args)
+        return image, (center[0] - ax, center[1] - ay)
+
+    def to_screen(self, points):
+        z = self.zoom
+        offset = (int(-self.camx * z), int(-self.camy * z))
+        return (np.asarray(points, dtype=np.float64) * z).astype(int) + offset
+
     def draw(self):
-        self.screen.fill((255, 255, 255))
-        vision_grid, border_grid, troops, cities = self.draw_info = json.loads(self.client.rcv())
+        # Draws the newest update, or the last one again if nothing came in since.
+        latest = self.receiver.take()
+        if latest is not None:
+            self.draw_info = latest[0]
+            self.motion.add(*latest)
+            self.pick_indexes = {}
+        elif not self.receiver.running:
+            self.done = True
+            return
+        snap = self.draw_info
+        if snap is None or self.terrain is None:
+            return
 
         z = self.zoom
+        self.screen.fill((255, 255, 255))
+        self.terrain.blit(self.screen, z, (int(-self.camx * z), int(-self.camy * z)))
 
-        terrain_surf = self.terrain_by_zoom[z]
-        offset_x = int(-self.camx * z)
-        offset_y = int(-self.camy * z)
-        self.screen.blit(terrain_surf, (offset_x, offset_y))
-
-        dyn_w = max(1, int(WORLD_X * z))
-        dyn_h = max(1, int(WORLD_Y * z))
-        dynamic = pygame.Surface((dyn_w, dyn_h), pygame.SRCALPHA)
-        fog = pygame.Surface((dyn_w, dyn_h), pygame.SRCALPHA)
+        dynamic = self.dynamic
+        fog = self.fog
+        dynamic.clear()
+        fog.clear()
 
         paths_to_draw = []
-        for color, position, cid, path, owner in cities:
+        sprites = []
+        city_screen = self.to_screen(snap.city_positions)
+        shown = dynamic.visible(city_screen[:, None], int(30 * z) + 1)
+        for position, (px, py), cid, owner, visible in zip(
+            snap.city_positions.tolist(),
+            city_screen.tolist(),
+            snap.city_ids.tolist(),
+            snap.city_owners.tolist(),
+            shown.tolist(),
+        ):
+            path = snap.city_paths.get(cid)
             if path and owner == self.player_num:
-                path.insert(0, position)
-                paths_to_draw.append(path)
-            if color is not None:
-                px = int(position[0] * z)
-                py = int(position[1] * z)
-
-                pole_bottom = (px, py)
-                pole_top = (px, int(py - 30 * z))
-                pygame.draw.line(dynamic, (80, 80, 80), pole_bottom, pole_top, max(1, int(3 * z)))
-
-                flag_color = tuple(color) if isinstance(color, (list, tuple)) else color
-                fw, fh = int(20 * z), int(14 * z)
-                p1 = (pole_top[0], pole_top[1])
-                p2 = (pole_top[0] + fw, pole_top[1] + fh // 2)
-                p3 = (pole_top[0], pole_top[1] + fh)
-                pygame.draw.polygon(dynamic, flag_color, [p1, p2, p3])
-                pygame.draw.polygon(dynamic, (0, 0, 0), [p1, p2, p3], max(1, int(1 * z)))
+                paths_to_draw.append([position, *path])
+            if owner >= 0 and visible:
+                color = COLORS[owner]
+                sprites.append(self.sprite(("flag", color), (px, py), draw_flag, z, color))
+        dynamic.blits(sprites)
 
         for path in paths_to_draw:
-            for i, pos in enumerate(path):
-                if not i == (len(path) - 1):
-                    px = int(pos[0] * z)
-                    py = int(pos[1] * z)
-                    px2 = int(path[i + 1][0] * z)
-                    py2 = int(path[i + 1][1] * z)
-                    pygame.draw.line(
-                        dynamic, (240, 180, 0), (px, py), (px2, py2), max(1, int(4 * z))
-                    )
+            dynamic.lines((240, 180, 0), self.to_screen(path), max(1, int(4 * z)))
 
         paths_to_draw = []
-        tids = [tid for tid, path in self.paths]
-        for pos, color, tid, owner, path, health in troops:
-            px = int(pos[0] * z)
-            py = int(pos[1] * z)
-            r = max(1, int(7 * z))
-            rgb = color
-
-            if tid in tids:
-                factor = 0.5
-                rgb = [max(0, min(255, int(x * factor))) for x in color]
+        sprites = []
+        tids = {tid for tid, path in self.paths}
+        r = max(1, int(7 * z))
+        bar = max(1, int(3 * z))
+        troop_positions = self.motion.positions(time.perf_counter())
+        troop_screen = self.to_screen(troop_positions)
+        shown = dynamic.visible(troop_screen[:, None], r + bar)
+        # Troops off screen are skipped, but their paths may still cross it.
+        rows = np.flatnonzero(shown | np.isin(snap.troop_ids, list(snap.troop_paths)))
+        for pos, (px, py), tid, owner, health, visible in zip(
+            troop_positions[rows].tolist(),
+            troop_screen[rows].tolist(),
+            snap.troop_ids[rows].tolist(),
+            snap.troop_owners[rows].tolist(),
+            snap.troop_health[rows].tolist(),
+            shown[rows].tolist(),
+        ):
+            color = COLORS[owner]
+            path = snap.troop_paths.get(tid)
             if path and owner == self.player_num:
-                path.insert(0, pos)
-                paths_to_draw.append(path)
-            pygame.draw.rect(
-                dynamic,
-                (0, 255, 0),
-                pygame.rect.Rect(
-                    px - r,
-                    (py - r) - max(1, int(3 * z)),
-                    (r * 2) * (health / 100),
-                    max(1, int(3 * z)),
-                ),
-            )
-            pygame.draw.circle(dynamic, rgb, (px, py), r)
+                paths_to_draw.append([pos, *path])
+            if not visible:
+                continue
+            width = int((r * 2) * (health / 100))
+            selected = tid in tids
+            key = ("troop", color, width, selected)
+            sprites.append(self.sprite(key, (px, py), draw_troop, z, color, width, selected))
+        dynamic.blits(sprites)
 
         for path in paths_to_draw:
-            for i, pos in enumerate(path):
-                if not i == (len(path) - 1):
-                    px = int(pos[0] * z)
-                    py = int(pos[1] * z)
-                    px2 = int(path[i + 1][0] * z)
-                    py2 = int(path[i + 1][1] * z)
-                    pygame.draw.line(dynamic, self.color, (px, py), (px2, py2), max(1, int(2 * z)))
+            dynamic.lines(self.color, self.to_screen(path), max(1, int(2 * z)))
 
         for tid, path in self.paths:
-            for i, pos in enumerate(path):
-                if not i == (len(path) - 1):
-                    px = int(pos[0] * z)
-                    py = int(pos[1] * z)
-                    px2 = int(path[i + 1][0] * z)
-                    py2 = int(path[i + 1][1] * z)
-                    pygame.draw.line(dynamic, (0, 0, 0), (px, py), (px2, py2), max(1, int(2 * z)))
+            dynamic.lines((0, 0, 0), self.to_screen(path), max(1, int(2 * z)))
         for tid, path in self.city_paths:
-            for i, pos in enumerate(path):
-                if not i == (len(path) - 1):
-                    px = int(pos[0] * z)
-                    py = int(pos[1] * z)
-                    px2 = int(path[i + 1][0] * z)
-                    py2 = int(path[i + 1][1] * z)
-                    pygame.draw.line(dynamic, (0, 0, 0), (px, py), (px2, py2), max(1, int(2 * z)))
-
-        for a, b in marching_squares(border_grid, CELL_SIZE, ROWS, COLS, THRESHOLD):
-            ax = int(a[0] * z)
-            ay = int(a[1] * z)
-            bx = int(b[0] * z)
-            by = int(b[1] * z)
-            pygame.draw.line(fog, (0, 0, 0), (ax, ay), (bx, by), max(1, int(3 * z)))
-
-        for poly in marching_squares_poly(vision_grid, CELL_SIZE, ROWS, COLS, THRESHOLD):
-            scaled = [(int(x * z), int(y * z)) for x, y in poly]
-            pygame.draw.polygon(fog, (0, 0, 0, 150), scaled, 0)
+            dynamic.lines((0, 0, 0), self.to_screen(path), max(1, int(2 * z)))
+
+        border_grid = self.grid_view("border", snap.border, snap.grid_bits)
+        segments = self.to_screen(self.border_contours.update(border_grid))
+        fog.segments((0, 0, 0), segments, max(1, int(3 * z)))
+
+        vision_grid = self.grid_view("vision", snap.vision, snap.grid_bits)
+        if self.fog_mode == "polygon":
+            polygons = self.fog_contours.update(vision_grid)
+            fog.polygons((0, 0, 0, 150), [self.to_screen(group) for group in polygons])
 
         if self.pause:
             font = pygame.font.SysFont(None, 48)
 
             text_surface = font.render("Pause", False, (0, 0, 0))
 
-            fog.blit(text_surface, (10, 10))
+            fog.draw(pygame.Surface.blit, text_surface, (10, 10))
+
+        dynamic.blit_to(self.screen)
+        if self.fog_mode == "raster":
+            camera = (self.camx, self.camy)
+            self.screen.blit(*self.raster_fog.render(vision_grid, z, camera, self.size))
+        fog.blit_to(self.screen)
+
 
-        self.screen.blit(dynamic, (offset_x, offset_y))
-        self.screen.blit(fog, (offset_x, offset_y))
+def main() -> None:
+    game_play = Game("WAR OF DOTS")
+    game_play.run_game()
 
 
-game_play = Game("WAR OF DOTS")
-game_play.run_game()
+if __name__ == "__main__":
+    main()
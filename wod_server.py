@@ -1,13 +1,21 @@
-import json
+import asyncio
+import itertools
 import math
+import multiprocessing
+import os
 import random
 import socket
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
 
+import numpy as np
 import perlin_noise
 
 import simple_socket
+import wire
 from constants import (
     CELL_SIZE,
     COLORS,
@@ -21,6 +29,15 @@ from constants import (
     WORLD_Y,
 )
 
+ATTACK_RANGE = 32
+BRUSH_SUBCELL_STEPS = 8  # Brush stamp centres snap to 1/8 of a cell, see max_weight_error().
+TERRAIN_SUBDIVISIONS = 4  # Terrain-class raster samples per cell along each axis.
+TERRAIN_CLASSES = (*TERRAIN_VALUES, "forest")
+HILL = TERRAIN_CLASSES.index("hill")
+FOREST = TERRAIN_CLASSES.index("forest")
+KEYFRAME_TICKS = 90  # Clients get a full snapshot at least this often, deltas otherwise.
+INPUT_TIMEOUT = 40 * wire.HEARTBEAT  # Connections silent for this long are dropped.
+
 
 def dir_dis_to_xy(direction, distance):
     return (
@@ -39,10 +56,10 @@ def xy_to_dir_dis(xy):
 
 class MarchingSquares:
     def __init__(self):
-        self.grid = [[0.0 for _ in range(COLS + 1)] for _ in range(ROWS + 1)]
+        self.grid = np.zeros((ROWS + 1, COLS + 1), dtype=np.float32)
 
     def set_grid(self, new_grid):
-        self.grid = new_grid
+        self.grid = np.array(new_grid, dtype=np.float32)
 
     def get_grid_value(self, x: float, y: float) -> float:
         x1, y1 = int(x), int(y)
@@ -50,10 +67,10 @@ class MarchingSquares:
 
         dx, dy = x - x1, y - y1
 
-        p11 = self.grid[x1][y1]
-        p21 = self.grid[x2][y1]
-        p12 = self.grid[x1][y2]
-        p22 = self.grid[x2][y2]
+        p11 = float(self.grid[x1, y1])
+        p21 = float(self.grid[x2, y1])
+        p12 = float(self.grid[x1, y2])
+        p22 = float(self.grid[x2, y2])
 
         #fmt: off
         return (
@@ -64,52 +81,349 @@ class MarchingSquares:
         )
         #fmt: on
 
+    def sample_many(self, xs, ys):
+        # Vectorised get_grid_value(): same bilinear weights, one call per batch of points.
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        x1, y1 = xs.astype(np.intp), ys.astype(np.intp)
+        dx, dy = xs - x1, ys - y1
+
+        # An extra edge row and column clamp the far corners, as get_grid_value() does.
+        edged = np.pad(self.grid, ((0, 1), (0, 1)), mode="edge")
+        width = edged.shape[1]
+        flat = edged.ravel()
+        i = x1 * width + y1
+        near = flat.take(i) + (flat.take(i + width) - flat.take(i)) * dx
+        far = flat.take(i + 1) + (flat.take(i + width + 1) - flat.take(i + 1)) * dx
+        return near + (far - near) * dy
+
 
 class Brush:
     def __init__(self, radius=40, strength=1.0, falloff=1.0):
         self.radius = radius
         self.strength = strength
         self.falloff = falloff
+        self.kernels = {}
+        self.log_kernels = {}
+
+    def max_weight_error(self):
+        # Snapping the centre moves it at most half a step along each axis, which shifts
+        # every weight by at most this much, plus |falloff| for cells right on the rim
+        # that flip in or out of the radius.  Centres on the snap lattice (e.g. cities,
+        # which sit on grid points) reproduce the exact per-cell weights.
+        snap = (CELL_SIZE / BRUSH_SUBCELL_STEPS) * math.sqrt(2) / 2
+        return abs(self.falloff - self.strength) * snap / self.radius + abs(self.falloff)
+
+    def kernel(self, sx, sy):
+        key = (self.radius, self.strength, self.falloff, sx, sy)
+        kernel = self.kernels.get(key)
+        if kernel is None:
+            cs = CELL_SIZE
+            r = float(self.radius)
+            reach = math.ceil(r / cs)
+            ks = np.arange(-reach, reach + 2)
+            dx = ks[:, None] * cs - sx * cs / BRUSH_SUBCELL_STEPS
+            dy = ks[None, :] * cs - sy * cs / BRUSH_SUBCELL_STEPS
+            dist_sq = dy * dy + dx * dx
+            t = np.sqrt(dist_sq) * (1.0 / r)
+            weight = self.strength + t * (self.falloff - self.strength)
+            kernel = self.kernels[key] = (weight, dist_sq <= r * r, -reach)
+        return kernel
 
     def apply(self, marching_squares, pos, target_value):
+        if self.radius <= 0:
+            return
         mx, my = pos
-        cs = CELL_SIZE
-        r = float(self.radius)
-        if r <= 0:
+        bx, sx = divmod(round(mx * BRUSH_SUBCELL_STEPS / CELL_SIZE), BRUSH_SUBCELL_STEPS)
+        by, sy = divmod(round(my * BRUSH_SUBCELL_STEPS / CELL_SIZE), BRUSH_SUBCELL_STEPS)
+        weight, mask, k0 = self.kernel(sx, sy)
+
+        r0, c0 = bx + k0, by + k0
+        row_start, row_end = max(0, r0), min(ROWS, r0 + weight.shape[0])
+        col_start, col_end = max(0, c0), min(COLS, c0 + weight.shape[1])
+        if row_start >= row_end or col_start >= col_end:
+            return
+
+        kr = slice(row_start - r0, row_end - r0)
+        kc = slice(col_start - c0, col_end - c0)
+        region = marching_squares.grid[row_start:row_end, col_start:col_end]
+        blended = np.clip(region + (target_value - region) * weight[kr, kc], 0.0, 1.0)
+        np.copyto(region, blended, where=mask[kr, kc])
+
+    def log_keeps(self):
+        # log(1 - weight) of the kernel for every snap offset, indexed [sx, sy]: zero
+        # outside the radius, and inside it held within [-1000, -tiny] so cells a stamp
+        # covers always sum below zero and full-weight ones do not make inf - inf later.
+        # Also the kernel's first row/column offset.
+        key = (self.radius, self.strength, self.falloff)
+        cached = self.log_kernels.get(key)
+        if cached is None:
+            steps = BRUSH_SUBCELL_STEPS
+            weight, _, k0 = self.kernel(0, 0)
+            size = weight.shape[0]
+            logs = np.zeros((steps, steps, size, size))
+            for sx in range(steps):
+                for sy in range(steps):
+                    weight, mask, _ = self.kernel(sx, sy)
+                    with np.errstate(divide="ignore"):
+                        covered = np.clip(np.log1p(-weight), -1000.0, -np.finfo(float).tiny)
+                    logs[sx, sy] = np.where(mask, covered, 0.0)
+            cached = self.log_kernels[key] = (logs, k0)
+        return cached
+
+    def apply_many(self, marching_squares, positions, target_value):
+        # apply() at each of positions in turn, in one pass.  Each stamp scales a cell's
+        # distance to the target by (1 - weight) and clips it into [0, 1], so for weights
+        # within [0, 1], as every brush in the game has, only the first stamp on a cell
+        # that starts outside [0, 1] can clip; the rest just multiply.
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        if self.radius <= 0 or not len(positions):
             return
+        log_keeps, k0 = self.log_keeps()
+        size = log_keeps.shape[2]
+        steps = np.rint(positions * BRUSH_SUBCELL_STEPS / CELL_SIZE).astype(np.intp)
+        cells, subcells = np.divmod(steps, BRUSH_SUBCELL_STEPS)
+        # Stamps land on a canvas with a kernel-wide margin all round; those wholly off
+        # the grid are pulled in only as far as the margin.
+        height, width = ROWS + 2 * size, COLS + 2 * size
+        cells = np.clip(cells, -(k0 + size), (ROWS - k0, COLS - k0)) + k0 + size
+        kernel = np.arange(size)[:, None] * width + np.arange(size)
+        flat = (cells[:, 0] * width + cells[:, 1])[:, None, None] + kernel
+        logs = log_keeps[subcells[:, 0], subcells[:, 1]]
+        sums = np.bincount(flat.ravel(), logs.ravel(), minlength=height * width)
+
+        region = marching_squares.grid[:ROWS, :COLS]
+        inner = (slice(size, size + ROWS), slice(size, size + COLS))
+        first = np.zeros((height, width))
+        outside = np.zeros((height, width), dtype=bool)
+        outside[inner] = (region < 0) | (region > 1)
+        if outside.any():
+            hit = outside.ravel()[flat] & (logs < 0)
+            stamp = np.nonzero(hit)[0]
+            hit_cells, hit_logs = flat[hit], logs[hit]
+            earliest = np.full(height * width, len(positions))
+            np.minimum.at(earliest, hit_cells, stamp)
+            firsts = stamp == earliest[hit_cells]
+            first.ravel()[hit_cells[firsts]] = hit_logs[firsts]
+
+        total, first = sums.reshape(height, width)[inner], first[inner]
+        clipped = np.clip(target_value + (region - target_value) * np.exp(first), 0.0, 1.0)
+        blended = target_value + (clipped - target_value) * np.exp(total - first)
+        np.clip(blended, 0.0, 1.0, out=blended)
+        np.copyto(region, blended, where=total < 0)
+
+
+class SpatialHash:
+    # Points sorted by group and by the bucket_size square they fall in, with where each
+    # bucket starts in that order, so a whole batch of queries finds what is in the 3x3
+    # buckets around each query point by array lookups.  Buckets are numbered over the
+    # bounding box of the points; those of one column are consecutive.
+
+    def __init__(self, bucket_size, points=(), groups=None):
+        self.bucket_size = bucket_size
+        self.rebuild(points, groups)
+
+    def cells(self, points, groups):
+        cells = np.floor(np.asarray(points, dtype=float).reshape(-1, 2) / self.bucket_size)
+        group = np.zeros(len(cells), np.intp) if groups is None else np.asarray(groups, np.intp)
+        return group, cells[:, 0].astype(np.intp), cells[:, 1].astype(np.intp)
+
+    def rebuild(self, points, groups=None):
+        group, bx, by = self.cells(points, groups)
+        if len(group):
+            self.low = np.array([0, bx.min(), by.min()])
+            self.shape = np.array([group.max() + 1, bx.max() + 1, by.max() + 1]) - self.low
+        else:
+            self.low, self.shape = np.zeros(3, np.intp), np.ones(3, np.intp)
+        index = self.index(group, bx, by)
+        self.order = np.argsort(index, kind="stable")
+        counts = np.bincount(index, minlength=self.shape.prod())
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+
+    def index(self, group, bx, by):
+        _, width, height = self.shape
+        return ((group - self.low[0]) * width + bx - self.low[1]) * height + by - self.low[2]
+
+    def pairs(self, queries, groups=None):
+        # (query index, point index) for every point of the query's group in the buckets
+        # around it.
+        group, bx, by = self.cells(queries, groups)
+        groups_n, width, height = self.shape
+        top = np.clip(by - 1, self.low[2], self.low[2] + height - 1)
+        bottom = np.clip(by + 1, self.low[2], self.low[2] + height - 1)
+        near = (group < groups_n) & (by + 1 >= self.low[2]) & (by - 1 < self.low[2] + height)
+        columns = bx + np.array([[-1], [0], [1]])
+        valid = near & (columns >= self.low[1]) & (columns < self.low[1] + width)
+        columns = np.where(valid, columns, self.low[1])
+        group = np.where(near, group, 0)
+        lo = self.starts[self.index(group, columns, top)]
+        hi = self.starts[self.index(group, columns, bottom) + 1]
+        counts = np.where(valid, hi - lo, 0).ravel()
+        query_idx = np.repeat(np.tile(np.arange(len(group)), 3), counts)
+        starts = np.repeat(lo.ravel() - (np.cumsum(counts) - counts), counts)
+        return query_idx, self.order[np.arange(len(query_idx)) + starts]
+
+
+def troop_pairs(owners, players, queries, positions, reach, friendly=False):
+    # (query slot, troop slot) for the troops possibly within reach of each query point:
+    # other troops of the same owner if friendly, troops of any other owner otherwise.
+    # With reach as the bucket size the 3x3 buckets around a query cover all of them.
+    troop_hash = SpatialHash(reach, positions, owners)
+    if friendly:
+        mine, other = troop_hash.pairs(queries, owners)
+        keep = mine != other
+        return mine[keep], other[keep]
+    n = len(owners)
+    rivals = [(owners + k) % players for k in range(1, players)]
+    mine, other = troop_hash.pairs(np.tile(queries, (players - 1, 1)), np.concatenate(rivals))
+    return mine % n, other
+
+
+def stamp_border(border, p_idx, cities, owners, old_positions, new_positions, brushes):
+    # cities is [(position, owner index or None)]; troops erase enemy border where they
+    # stood at the start of the tick and paint their own where they ended it, erasing
+    # first.
+    city_border_brush, border_brush = brushes
+    for position, owner in cities:
+        if owner == p_idx:
+            city_border_brush.apply(border, position, 1.0)
+    for position, owner in cities:
+        if owner is not None and owner != p_idx:
+            city_border_brush.apply(border, position, 0.0)
+    mine = np.asarray(owners) == p_idx
+    border_brush.apply_many(border, np.asarray(old_positions)[~mine], 0.0)
+    border_brush.apply_many(border, np.asarray(new_positions)[mine], 1.0)
+
+
+def stamp_vision(vision, sources, brushes):
+    city_vision_brush, vision_brush = brushes
+    city_positions, troop_positions, on_hill = sources
+    troop_positions = np.asarray(troop_positions, dtype=float).reshape(-1, 2)
+    on_hill = np.asarray(on_hill, dtype=bool)
+    city_vision_brush.apply_many(
+        vision,
+        np.concatenate([np.reshape(city_positions, (-1, 2)), troop_positions[on_hill]]),
+        0,
+    )
+    vision_brush.apply_many(vision, troop_positions[~on_hill], 0)
+
+
+_field_worker = {}
 
-        col_start = max(0, int((my - r) / cs))
-        col_end = min(COLS, int((my + r) / cs) + 1)
-        row_start = max(0, int((mx - r) / cs))
-        row_end = min(ROWS, int((mx + r) / cs) + 1)
 
-        inv_r = 1.0 / r
-        grid = marching_squares.grid
-        strength = self.strength
-        falloff = self.falloff
+def _init_field_worker(fields_name, shape, brushes, default_vision):
+    fields_shm = shared_memory.SharedMemory(name=fields_name, track=False)
+    _field_worker.update(
+        fields_shm=fields_shm,
+        fields=np.ndarray(shape, dtype=np.float32, buffer=fields_shm.buf),
+        brushes=[Brush(*params) for params in brushes],
+        default_vision=default_vision,
+        troops_shm=None,
+    )
+
 
-        for j in range(row_start, row_end):
-            px = j * cs
-            dx_sq = (px - mx) ** 2
-            row = grid[j]
+def _attached_troops(name, n):
+    troops_shm = _field_worker["troops_shm"]
+    if troops_shm is None or troops_shm.name != name:
+        if troops_shm is not None:
+            troops_shm.close()
+        troops_shm = shared_memory.SharedMemory(name=name, track=False)
+        _field_worker["troops_shm"] = troops_shm
+    return np.ndarray((troops_shm.size // (5 * 8), 5), buffer=troops_shm.buf)[:n]
+
+
+def _stamp_border_task(p_idx, troops_name, n, cities):
+    troops = _attached_troops(troops_name, n)
+    border = MarchingSquares()
+    border.grid = _field_worker["fields"][p_idx, 0]
+    city_border_brush, border_brush = _field_worker["brushes"][:2]
+    stamp_border(
+        border,
+        p_idx,
+        cities,
+        troops[:, 4].astype(int),
+        troops[:, 0:2],
+        troops[:, 2:4],
+        (city_border_brush, border_brush),
+    )
 
-            for i in range(col_start, col_end):
-                py = i * cs
-                dy = py - my
-                dist_sq = dy * dy + dx_sq
 
-                if dist_sq <= r * r:
-                    dist = math.sqrt(dist_sq)
-                    t = dist * inv_r
+def _stamp_vision_task(p_idx, sources):
+    vision = MarchingSquares()
+    vision.grid = _field_worker["fields"][p_idx, 1]
+    vision.grid[:] = _field_worker["default_vision"]
+    stamp_vision(vision, sources, _field_worker["brushes"][2:])
 
-                    weight = strength + t * (falloff - strength)
 
-                    old = row[i]
-                    row[i] = max(0.0, min(1.0, old + (target_value - old) * weight))
+class FieldPool:
+    # Per-player border and vision fields in shared memory, stamped by worker processes.
+    # Troop positions for a tick are handed over in a second shared buffer, rows of
+    # (old x, old y, new x, new y, owner), grown by reallocation.
+    def __init__(self, environment, workers=None):
+        players = environment.players
+        shape = (len(players), 2, ROWS + 1, COLS + 1)
+        self.fields_shm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        )
+        self.fields = np.ndarray(shape, dtype=np.float32, buffer=self.fields_shm.buf)
+        for p_idx, player in enumerate(players):
+            self.fields[p_idx, 0] = player.border.grid
+            player.border.grid = self.fields[p_idx, 0]
+        self.troops_shm = shared_memory.SharedMemory(create=True, size=256 * 5 * 8)
+        brushes = [
+            (brush.radius, brush.strength, brush.falloff)
+            for brush in (
+                environment.city_border_brush,
+                environment.border_brush,
+                environment.city_vision_brush,
+                environment.vision_brush,
+            )
+        ]
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers or min(len(players), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_field_worker,
+            initargs=(self.fields_shm.name, shape, brushes, environment.default_vision),
+        )
+        self.vision_lock = threading.Lock()
+
+    def stamp_borders(self, cities, owners, old_positions, new_positions):
+        n = len(owners)
+        if n > self.troops_shm.size // (5 * 8):
+            self.troops_shm.close()
+            self.troops_shm.unlink()
+            self.troops_shm = shared_memory.SharedMemory(create=True, size=max(256, 2 * n) * 5 * 8)
+        troops = np.ndarray((n, 5), buffer=self.troops_shm.buf)
+        if n:
+            troops[:, 0:2] = old_positions
+            troops[:, 2:4] = new_positions
+            troops[:, 4] = owners
+        futures = [
+            self.executor.submit(_stamp_border_task, p_idx, self.troops_shm.name, n, cities)
+            for p_idx in range(len(self.fields))
+        ]
+        for future in futures:
+            future.result()
+
+    def vision(self, p_idx, sources):
+        with self.vision_lock:
+            self.executor.submit(_stamp_vision_task, p_idx, sources).result()
+            return self.fields[p_idx, 1].copy()
+
+    def close(self, players):
+        # The borders are views into fields_shm; give them back private copies so the
+        # environment stays usable once the segment is unmapped.
+        self.executor.shutdown()
+        for player in players:
+            player.border.grid = player.border.grid.copy()
+        del self.fields
+        for shm in (self.fields_shm, self.troops_shm):
+            shm.close()
+            shm.unlink()
 
 
 class Environment:
-    def __init__(self):
+    def __init__(self, parallel=False):
         self.terrain_speeds = {
             "water": 0.6,
             "forest": 0.8,
@@ -124,18 +438,25 @@ class Environment:
             "hill": 1.5,
             "mountain": 0,
         }
+        self.class_speeds = [self.terrain_speeds[name] for name in TERRAIN_CLASSES]
+        self.class_attacks = [self.terrain_attacks[name] for name in TERRAIN_CLASSES]
+        self.class_passable = [name != "mountain" for name in TERRAIN_CLASSES]
         self.terrain_marching = MarchingSquares()
         self.forest_marching = MarchingSquares()
 
         self.cities = []
+        self.troops = TroopTable()
+        self.entity_ids = itertools.count(1)
+        self.tick = 0
 
-        self.default_vision = [[0.0 for _ in range(COLS + 1)] for _ in range(ROWS + 1)]
-        for y in range(COLS + 1):
-            for x in range(ROWS + 1):
-                self.default_vision[x][y] = 0.0
+        self.default_vision = np.zeros((ROWS + 1, COLS + 1))
 
         self.generate_terrain()
+        self.generate_terrain_classes()
         self.generate_default_vision()
+        for city in self.cities:
+            city.id = self.new_entity_id()
+        self.city_slots = {city.id: i for i, city in enumerate(self.cities)}
         # 2 players left and right most cities
         # 3 players left-bottom, top, right-bottom
         # 4 players left-bottom, top-left, top-right, right-bottom
@@ -216,11 +537,30 @@ class Environment:
             middle_bottom_city.owner = self.players[3]
             top_right_city.owner = self.players[4]
             right_bottom_city.owner = self.players[5]
+        for p_idx, player in enumerate(self.players):
+            self.add_troop(player.start_pos, p_idx)
+        self.update_city_fields()
         self.vision_brush = Brush(75, 1, 0)
         self.city_vision_brush = Brush(175, 1, 0)
         self.border_brush = Brush(40, 0.05, 0)
         self.city_border_brush = Brush(80, 0.05, 0)
+        self.field_pool = FieldPool(self) if parallel else None
         self.players_in_cities = [[] for _ in self.cities]
+        self.publish(None)
+
+    def close(self):
+        if self.field_pool is not None:
+            self.field_pool.close(self.players)
+            self.field_pool = None
+
+    def new_entity_id(self):
+        # Monotonic, never reused: a stale order for a dead troop matches nothing.
+        return next(self.entity_ids)
+
+    def add_troop(self, position, owner, path=None):
+        tid = self.new_entity_id()
+        self.troops.add(tid, position, owner, path)
+        return tid
 
     def generate_terrain(self):
         def elevation_bias(x, y):
@@ -290,6 +630,33 @@ class Environment:
                 distance = max(2, distance - 2)
                 tries = 0
 
+    def generate_terrain_classes(self, subdivisions=TERRAIN_SUBDIVISIONS):
+        # Terrain is static once generated, so classify it once on a fine raster and
+        # let the move path do a single index instead of two bilinear samples.
+        self.terrain_subdivisions = subdivisions
+        xs = np.arange(ROWS * subdivisions + 1) / subdivisions
+        ys = np.arange(COLS * subdivisions + 1) / subdivisions
+        gx, gy = np.meshgrid(xs, ys, indexing="ij")
+        terrain = self.terrain_marching.sample_many(gx, gy)
+        forest = self.forest_marching.sample_many(gx, gy)
+        classes = np.zeros(gx.shape, dtype=np.int8)
+        for idx, value in enumerate(TERRAIN_VALUES.values()):
+            classes[terrain > value] = idx
+        classes[forest > THRESHOLD] = FOREST
+        self.terrain_classes = classes
+
+    def terrain_classes_at(self, positions):
+        sub = self.terrain_subdivisions
+        x = np.clip(np.rint(positions[:, 0] * sub / CELL_SIZE), 0, ROWS * sub).astype(np.intp)
+        y = np.clip(np.rint(positions[:, 1] * sub / CELL_SIZE), 0, COLS * sub).astype(np.intp)
+        return self.terrain_classes[x, y].astype(np.intp)
+
+    def terrain_class_at(self, pos):
+        sub = self.terrain_subdivisions
+        x = min(max(round(pos[0] * sub / CELL_SIZE), 0), ROWS * sub)
+        y = min(max(round(pos[1] * sub / CELL_SIZE), 0), COLS * sub)
+        return int(self.terrain_classes[x, y])
+
     def generate_default_vision(self):
         for y in range(COLS + 1):
             for x in range(ROWS + 1):
@@ -300,11 +667,95 @@ class Environment:
                     + (0.8 if forest_value > 0.6 else 0.0)
                 )
 
+    def publish(self, vision_sources):
+        # Swap in a World for the tick that just finished.  Senders only read self.world,
+        # so they never see a tick half done whichever thread runs the simulation.
+        table = self.troops
+        n = table.count
+        city_owners = np.array(
+            [self.players.index(c.owner) if c.owner is not None else -1 for c in self.cities]
+        )
+        world = World(
+            tick=self.tick,
+            troop_ids=table.id[:n].copy(),
+            troop_owners=table.owner[:n].copy(),
+            troop_positions=table.position[:n].copy(),
+            troop_health=table.health[:n].copy(),
+            troop_paths={
+                tid: list(path) for tid, path in zip(table.id[:n].tolist(), table.paths) if path
+            },
+            city_ids=np.array([c.id for c in self.cities]),
+            city_owners=city_owners,
+            city_positions=np.array([c.position for c in self.cities], dtype=float),
+            city_paths={c.id: list(c.path) for c in self.cities if c.path},
+            borders=np.array([player.border.grid for player in self.players]),
+            vision_sources=vision_sources,
+        )
+        for value in vars(world).values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        self.world = world
+
+    def get_vision(self, player, world=None):
+        # Vision is only stamped when someone asks for it, at most once per tick.
+        ply = self.players[player]
+        if world is None:
+            world = self.world
+        tick, sources = world.tick, world.vision_sources
+        if ply.vision_tick != tick:
+            vision = MarchingSquares()
+            if sources is None:
+                vision.set_grid(self.default_vision)
+            elif self.field_pool is not None:
+                vision.grid = self.field_pool.vision(player, sources[player])
+            else:
+                vision.set_grid(self.default_vision)
+                stamp_vision(vision, sources[player], (self.city_vision_brush, self.vision_brush))
+            ply.vision, ply.vision_tick = vision, tick
+        return ply.vision
+
+    def visible_troops(self, vision, positions):
+        gx = np.clip(positions[:, 0] / CELL_SIZE, 0, ROWS)
+        gy = np.clip(positions[:, 1] / CELL_SIZE, 0, COLS)
+        return np.flatnonzero(vision.sample_many(gx, gy) < THRESHOLD)
+
+    def snapshot(self, player, grid_bits=wire.GRID_BITS, world=None):
+        # Built from a published World only, never from the live tables.
+        if world is None:
+            world = self.world
+        vision = self.get_vision(player, world)
+        visible = self.visible_troops(vision, world.troop_positions)
+        troop_ids = world.troop_ids[visible]
+        owners = world.troop_owners[visible]
+        return wire.Snapshot(
+            tick=world.tick,
+            vision=wire.quantize(vision.grid, grid_bits),
+            border=wire.quantize(world.borders[player], grid_bits),
+            troop_ids=troop_ids,
+            troop_owners=owners,
+            troop_positions=world.troop_positions[visible],
+            troop_health=world.troop_health[visible],
+            city_ids=world.city_ids,
+            city_owners=world.city_owners,
+            city_positions=world.city_positions,
+            grid_bits=grid_bits,
+            troop_paths={
+                tid: world.troop_paths[tid]
+                for tid in troop_ids[owners == player].tolist()
+                if tid in world.troop_paths
+            },
+            city_paths={
+                cid: world.city_paths[cid]
+                for cid, owner in zip(world.city_ids.tolist(), world.city_owners.tolist())
+                if owner == player and cid in world.city_paths
+            },
+        )
+
     def draw_info(self, player):
         ply = self.players[player]
-        vision_grid = ply.vision.grid
-        border_grid = ply.border.grid
-        troops = []
+        vision = self.get_vision(player)
+        vision_grid = vision.grid.tolist()
+        border_grid = ply.border.grid.tolist()
         cities = [
             (
                 c.owner.color if c.owner is not None else None,
@@ -315,27 +766,25 @@ class Environment:
             )
             for c in self.cities
         ]
-        for troop in [t for p in self.players for t in p.troops]:
-            ply = self.players[player]
-
-            vision = ply.vision
-            px, py = troop.position
-            gx = px / CELL_SIZE
-            gy = py / CELL_SIZE
-            gx = max(0, min(ROWS, gx))
-            gy = max(0, min(COLS, gy))
-
-            if vision.get_grid_value(gx, gy) < THRESHOLD:
-                troops.append(
-                    (
-                        troop.position,
-                        troop.owner.color,
-                        troop.id,
-                        self.players.index(troop.owner),
-                        troop.path,
-                        troop.health,
-                    )
-                )
+        table = self.troops
+        visible = self.visible_troops(vision, table.position[: table.count])
+        troops = [
+            (
+                tuple(position),
+                self.players[owner].color,
+                tid,
+                owner,
+                table.paths[slot],
+                health,
+            )
+            for slot, position, owner, tid, health in zip(
+                visible.tolist(),
+                table.position[visible].tolist(),
+                table.owner[visible].tolist(),
+                table.id[visible].tolist(),
+                table.health[visible].tolist(),
+            )
+        ]
 
         return vision_grid, border_grid, troops, cities
 
@@ -343,248 +792,193 @@ class Environment:
         return (
             self.terrain_marching.grid,
             self.forest_marching.grid,
-            [c.position for c in self.cities],
+            np.array([c.position for c in self.cities], dtype=float).reshape(-1, 2),
         )
 
-    def get_terrain_name(self, value, fvalue):
-        if fvalue > THRESHOLD:
-            return "forest"
-        for name, v in reversed(TERRAIN_VALUES.items()):
-            if value > v:
-                return name
-
-    def update_troops(self, paths_to_apply):  # split into more functions ?
+    def update_troops(self, paths_to_apply):
+        table = self.troops
+        n = table.count
         self.players_in_cities = [[] for _ in self.cities]
-        troop_ids = [info[0] for info in paths_to_apply]
-        troop_paths = [info[1] for info in paths_to_apply]
-        for player in self.players:
-            player.vision.grid = [row[:] for row in self.default_vision]
-            for city in self.cities:
-                if city.owner is player:
-                    self.city_vision_brush.apply(player.vision, city.position, 0)
-                    self.city_border_brush.apply(player.border, city.position, 1.0)
-            for other_player in self.players:
-                if player is not other_player:
-                    for city in self.cities:
-                        if city.owner is other_player:
-                            self.city_border_brush.apply(player.border, city.position, 0.0)
-            to_remove = []
-            for troop in player.troops:
-                if troop.health <= 0:
-                    to_remove.append(troop)
-                    continue
-                try:
-                    tidx = troop_ids.index(id(troop))
-                    troop.path = troop_paths[tidx]
-                except ValueError:
-                    pass
-
-                old_pos = troop.position
-                owned = [city.position for city in self.cities if city.owner is player]
-                if owned:
-                    closest_city = min(
-                        owned,
-                        key=lambda x: xy_to_dir_dis(((old_pos[0] - x[0]), (old_pos[1] - x[1])))[1],
-                    )
-                    city_dir, city_dist = xy_to_dir_dis(
-                        ((old_pos[0] - closest_city[0]), (old_pos[1] - closest_city[1]))
-                    )
-                    sample_points = [
-                        dir_dis_to_xy(city_dir, dist * 20) for dist in range(int(city_dist // 20))
-                    ]
-                    border_avg = 0
-                    if sample_points:
-                        border_avgs = []
-                        for other_player in self.players:
-                            if other_player is not player:
-                                border_avgs.append(
-                                    sum(
-                                        [
-                                            other_player.border.get_grid_value(
-                                                (closest_city[0] + s_p[0]) / CELL_SIZE,
-                                                (closest_city[1] + s_p[1]) / CELL_SIZE,
-                                            )
-                                            for s_p in sample_points
-                                        ]
-                                    )
-                                    / len(sample_points)
-                                )
-                        border_avg = sum(border_avgs) / len(border_avgs)
-                    dist_penal = max(((city_dist + 250) / 1000), 0.5)
-                    healing_power = (1 - (border_avg / 2)) - dist_penal
-                else:
-                    healing_power = -0.5
-                troop.health += healing_power / 25
-                if troop.health > 100:
-                    troop.health = 100
-
-                enemies_in_range = []
-
-                gx = old_pos[0] / CELL_SIZE
-                gy = old_pos[1] / CELL_SIZE
-
-                terrain = self.terrain_marching.get_grid_value(gx, gy)
-                forest = self.forest_marching.get_grid_value(gx, gy)
-                on_terrain = self.get_terrain_name(terrain, forest)
-
-                if troop.path:
-                    target = troop.path[0]
+        for tid, path in dict(paths_to_apply).items():
+            slot = table.slots.get(tid)
+            if slot is not None:
+                table.paths[slot] = path
+
+        players = len(self.players)
+        owners = table.owner[:n].astype(np.int64)
+        old_positions = table.position[:n].copy()
+
+        self.heal_troops()
+
+        # Every troop moves against where the others stood at the start of the tick.
+        on_terrains = self.terrain_classes_at(old_positions)
+        speeds = np.asarray(self.class_speeds)[on_terrains]
+        moving = np.array([bool(path) for path in table.paths], dtype=bool)
+        movers = np.flatnonzero(moving)
+        waypoints = [table.paths[slot][0] for slot in movers.tolist()]
+        targets = np.array(waypoints, dtype=float).reshape(-1, 2)
+        heading = targets - old_positions[movers]
+        angle = np.arctan2(heading[:, 1], heading[:, 0])
+        steps = speeds[movers, None] * 0.1 * np.stack((np.cos(angle), np.sin(angle)), axis=1)
+        new_positions = old_positions.copy()
+        new_positions[movers] += steps
+
+        # Friendly troops closer than 14 (moving) or 15 (idle) push this one away: out to
+        # 14, or 0.025 further, along the line between them.
+        mine, other = troop_pairs(owners, players, new_positions, old_positions, 15, friendly=True)
+        offsets = new_positions[mine] - old_positions[other]
+        dist = np.hypot(offsets[:, 0], offsets[:, 1])
+        pushed = np.where(moving[mine], dist < 14, dist < 15)
+        mine, offsets, dist = mine[pushed], offsets[pushed], dist[pushed]
+        offsets[dist == 0] = (1.0, 0.0)
+        dist[dist == 0] = 1.0
+        grow = np.where(moving[mine], 14 / dist - 1, 0.025 / dist)
+        new_positions[:, 0] += np.bincount(mine, offsets[:, 0] * grow, minlength=n)
+        new_positions[:, 1] += np.bincount(mine, offsets[:, 1] * grow, minlength=n)
+        new_terrains = self.terrain_classes_at(new_positions)
+
+        # Enemies within 28 block the move; the closest within ATTACK_RANGE is attacked.
+        mine, other = troop_pairs(owners, players, new_positions, old_positions, ATTACK_RANGE)
+        offsets = new_positions[mine] - old_positions[other]
+        dist2 = offsets[:, 0] ** 2 + offsets[:, 1] ** 2
+        hit_enemy = np.zeros(n, dtype=bool)
+        hit_enemy[mine[dist2 < 28**2]] = True
+        in_range = dist2 < ATTACK_RANGE**2
+        mine, other, dist2 = mine[in_range], other[in_range], dist2[in_range]
+        order = np.argsort(mine * float(ATTACK_RANGE**2) + dist2)
+        mine, other = mine[order], other[order]
+        closest = np.ones(len(mine), dtype=bool)
+        closest[1:] = mine[1:] != mine[:-1]
+        attackers, victims = mine[closest], other[closest]
+
+        x, y = new_positions[:, 0], new_positions[:, 1]
+        in_world = (x <= WORLD_X) & (x >= 0) & (y <= WORLD_Y) & (y >= 0)
+        moved = np.asarray(self.class_passable)[new_terrains] & ~hit_enemy & in_world
+        positions = np.where(moved[:, None], new_positions, old_positions)
+        on_terrains = np.where(moved, new_terrains, on_terrains)
+
+        left = targets - positions[movers]
+        arrived = left[:, 0] ** 2 + left[:, 1] ** 2 < (speeds[movers] * 2) ** 2
+        for slot in movers[arrived].tolist():
+            table.paths[slot].pop(0)
+
+        attacks = np.asarray(self.class_attacks, dtype=float)[on_terrains[attackers]] / 25
+        damage = np.bincount(victims, attacks, minlength=n)
+
+        # A troop is in the first city within 15 of it.
+        city_positions = np.array([city.position for city in self.cities], dtype=float)
+        offsets = positions[:, None, :] - city_positions.reshape(1, -1, 2)
+        in_city = (offsets**2).sum(axis=2) < 15**2
+        for slot in np.flatnonzero(in_city.any(axis=1)).tolist():
+            i = int(in_city[slot].argmax())
+            self.players_in_cities[i].append(self.players[owners[slot]])
 
-                    terrain_speed = self.terrain_speeds[on_terrain]
-                    dir, distance = xy_to_dir_dis(
-                        (
-                            target[0] - old_pos[0],
-                            target[1] - old_pos[1],
-                        )
-                    )
-                    distance = terrain_speed * 0.1
-                    new_off_x, new_off_y = dir_dis_to_xy(dir, distance)
-
-                    new_pos = (
-                        old_pos[0] + new_off_x,
-                        old_pos[1] + new_off_y,
-                    )
-
-                    for other_t in player.troops:
-                        if other_t == troop:
-                            continue
-                        other_x, other_y = other_t.position
-                        old_off_x, old_off_y = (
-                            new_pos[0] - other_x,
-                            new_pos[1] - other_y,
-                        )
-                        dir, distance = xy_to_dir_dis((old_off_x, old_off_y))
-                        if distance < 14:
-                            distance = 14
-                            new_off_x, new_off_y = dir_dis_to_xy(dir, distance)
-                            change_x, change_y = (
-                                new_off_x - old_off_x,
-                                new_off_y - old_off_y,
-                            )
-                            new_pos = (new_pos[0] + change_x, new_pos[1] + change_y)
-
-                    gx = new_pos[0] / CELL_SIZE
-                    gy = new_pos[1] / CELL_SIZE
-                    terrain = self.terrain_marching.get_grid_value(gx, gy)
-                    forest = self.forest_marching.get_grid_value(gx, gy)
-                    new_terrain = self.get_terrain_name(terrain, forest)
-
-                    hit_enemy = False
-
-                    for other_player in self.players:
-                        if player is not other_player:
-                            self.border_brush.apply(other_player.border, troop.position, 0.0)
-                            for other_t in other_player.troops:
-                                other_x, other_y = other_t.position
-                                off_x, off_y = (
-                                    new_pos[0] - other_x,
-                                    new_pos[1] - other_y,
-                                )
-                                dir, distance = xy_to_dir_dis((off_x, off_y))
-                                if distance < 28:
-                                    hit_enemy = True
-                                if distance < 32:
-                                    enemies_in_range.append((other_t, distance))
-
-                    out_of_world = (
-                        (new_pos[0] > WORLD_X)
-                        or (new_pos[0] < 0)
-                        or (new_pos[1] > WORLD_Y)
-                        or (new_pos[1] < 0)
-                    )
-                    if (not new_terrain == "mountain") and not hit_enemy and not out_of_world:
-                        troop.position = new_pos
-                        on_terrain = new_terrain
-
-                    dir, distance = xy_to_dir_dis(
-                        (target[0] - troop.position[0], target[1] - troop.position[1])
-                    )
-                    if distance < (terrain_speed * 2):
-                        troop.path.pop(0)
-                else:
-                    new_pos = old_pos
-
-                    for other_t in player.troops:
-                        if other_t == troop:
-                            continue
-                        other_x, other_y = other_t.position
-                        old_off_x, old_off_y = (
-                            new_pos[0] - other_x,
-                            new_pos[1] - other_y,
-                        )
-                        dir, distance = xy_to_dir_dis((old_off_x, old_off_y))
-                        if distance < 15:
-                            distance += 0.025
-                            new_off_x, new_off_y = dir_dis_to_xy(dir, distance)
-                            change_x, change_y = (
-                                new_off_x - old_off_x,
-                                new_off_y - old_off_y,
-                            )
-                            new_pos = (new_pos[0] + change_x, new_pos[1] + change_y)
-
-                    gx = new_pos[0] / CELL_SIZE
-                    gy = new_pos[1] / CELL_SIZE
-                    terrain = self.terrain_marching.get_grid_value(gx, gy)
-                    forest = self.forest_marching.get_grid_value(gx, gy)
-                    new_terrain = self.get_terrain_name(terrain, forest)
-
-                    hit_enemy = False
-
-                    for other_player in self.players:
-                        if player is not other_player:
-                            self.border_brush.apply(other_player.border, troop.position, 0.0)
-                            for other_t in other_player.troops:
-                                other_x, other_y = other_t.position
-                                off_x, off_y = (
-                                    new_pos[0] - other_x,
-                                    new_pos[1] - other_y,
-                                )
-                                dir, distance = xy_to_dir_dis((off_x, off_y))
-                                if distance < 28:
-                                    hit_enemy = True
-                                if distance < 32:
-                                    enemies_in_range.append((other_t, distance))
-
-                    out_of_world = (
-                        (new_pos[0] > WORLD_X)
-                        or (new_pos[0] < 0)
-                        or (new_pos[1] > WORLD_Y)
-                        or (new_pos[1] < 0)
-                    )
-                    if (not new_terrain == "mountain") and not hit_enemy and not out_of_world:
-                        troop.position = new_pos
-                        on_terrain = new_terrain
-
-                if enemies_in_range:
-                    attack_power = self.terrain_attacks[on_terrain] / 25
-                    closest = min(enemies_in_range, key=lambda x: x[1])
-                    closest[0].health -= attack_power
+        cities = [
+            (city.position, self.players.index(city.owner) if city.owner is not None else None)
+            for city in self.cities
+        ]
+        if self.field_pool is not None:
+            self.field_pool.stamp_borders(cities, owners, old_positions, positions)
+        else:
+            for p_idx, player in enumerate(self.players):
+                stamp_border(
+                    player.border,
+                    p_idx,
+                    cities,
+                    owners,
+                    old_positions,
+                    positions,
+                    (self.city_border_brush, self.border_brush),
+                )
 
-                if on_terrain == "hill":
-                    self.city_vision_brush.apply(player.vision, troop.position, 0)
-                else:
-                    self.vision_brush.apply(player.vision, troop.position, 0)
-                self.border_brush.apply(player.border, troop.position, 1.0)
-                for i, city in enumerate(self.cities):
-                    cx, cy = city.position
-                    tx, ty = troop.position
-                    dir, dist = xy_to_dir_dis((tx - cx, ty - cy))
-                    if dist < 15:
-                        self.players_in_cities[i].append(player)
-                        break
-            to_remove.reverse()
-            for t in to_remove:
-                player.troops.remove(t)
+        vision_sources = []
+        for p_idx in range(len(self.players)):
+            mine = owners == p_idx
+            vision_sources.append(
+                (
+                    [position for position, owner in cities if owner == p_idx],
+                    positions[mine],
+                    on_terrains[mine] == HILL,
+                )
+            )
+        self.tick += 1
+
+        table.position[:n] = positions
+        table.health[:n] -= damage
+        table.alive[:n] = table.health[:n] > 0
+        table.compact()
+        self.publish(vision_sources)
+
+    def update_city_fields(self):
+        # Nearest owned city for every raster point, per player; only ownership changes
+        # invalidate it.  Near a Voronoi edge the picked city can be a raster step off
+        # the true nearest one, which moves city_dist by less than a step.
+        sub = self.terrain_subdivisions
+        gx, gy = np.meshgrid(
+            np.arange(ROWS * sub + 1) * (CELL_SIZE / sub),
+            np.arange(COLS * sub + 1) * (CELL_SIZE / sub),
+            indexing="ij",
+        )
+        self.nearest_city = []
+        for player in self.players:
+            owned = [i for i, city in enumerate(self.cities) if city.owner is player]
+            if not owned:
+                self.nearest_city.append(None)
+                continue
+            cx, cy = np.array([self.cities[i].position for i in owned], dtype=float).T
+            dist_sq = (gx[..., None] - cx) ** 2 + (gy[..., None] - cy) ** 2
+            self.nearest_city.append(np.array(owned, dtype=np.int16)[dist_sq.argmin(axis=-1)])
+
+    def border_obstruction(self, players, origins, offsets, dists):
+        # Mean of the players' border fields sampled every 20 units along each ray from
+        # origin towards origin + offset.  Bilinear sampling is linear, so averaging the
+        # fields first equals averaging each player's samples.
+        steps = (dists // 20).astype(np.intp)
+        total = int(steps.sum())
+        if not total:
+            return np.zeros(len(dists))
+        k = np.arange(total) - np.repeat(np.cumsum(steps) - steps, steps)
+        step = offsets * (20 / CELL_SIZE) / np.where(dists > 0, dists, 1)[:, None]
+        xs = np.repeat(origins[:, 0] / CELL_SIZE, steps) + np.repeat(step[:, 0], steps) * k
+        ys = np.repeat(origins[:, 1] / CELL_SIZE, steps) + np.repeat(step[:, 1], steps) * k
+        ray = np.repeat(np.arange(len(dists)), steps)
+        field = MarchingSquares()
+        field.grid = np.mean([player.border.grid for player in players], axis=0)
+        samples = np.bincount(ray, field.sample_many(xs, ys), minlength=len(dists))
+        return samples / np.maximum(steps, 1)
+
+    def heal_troops(self):
+        table = self.troops
+        n = table.count
+        position = table.position[:n]
+        healing_power = np.full(n, -0.5)
+        sub = self.terrain_subdivisions
+        ix = np.clip(np.rint(position[:, 0] * sub / CELL_SIZE), 0, ROWS * sub).astype(np.intp)
+        iy = np.clip(np.rint(position[:, 1] * sub / CELL_SIZE), 0, COLS * sub).astype(np.intp)
+        city_positions = np.array([city.position for city in self.cities], dtype=float)
+        for p_idx, player in enumerate(self.players):
+            nearest = self.nearest_city[p_idx]
+            mine = np.flatnonzero(table.owner[:n] == p_idx)
+            if nearest is None or not len(mine):
+                continue
+            closest_city = city_positions[nearest[ix[mine], iy[mine]]]
+            offsets = position[mine] - closest_city
+            city_dist = np.hypot(offsets[:, 0], offsets[:, 1])
+            others = [other for other in self.players if other is not player]
+            border_avg = np.zeros(len(mine))
+            if others:
+                border_avg = self.border_obstruction(others, closest_city, offsets, city_dist)
+            dist_penal = np.maximum((city_dist + 250) / 1000, 0.5)
+            healing_power[mine] = (1 - (border_avg / 2)) - dist_penal
+        table.health[:n] = np.minimum(table.health[:n] + healing_power / 25, 100)
 
     def update_cities(self, paths_to_apply):
-        city_ids = [info[0] for info in paths_to_apply]
-        city_paths = [info[1] for info in paths_to_apply]
+        for cid, path in dict(paths_to_apply).items():
+            i = self.city_slots.get(cid)
+            if i is not None:
+                self.cities[i].path = path
+        ownership_changed = False
         for i, city in enumerate(self.cities):
-            try:
-                cidx = city_ids.index(id(city))
-                city.path = city_paths[cidx]
-            except ValueError:
-                pass
             cx, cy = city.position
             last_owner = city.owner
             if len(self.players_in_cities[i]) == 1:
@@ -592,32 +986,104 @@ class Environment:
             if last_owner is not city.owner:
                 city.timer = 0
                 city.path = []
+                ownership_changed = True
             if city.owner is not None:
                 city.timer += 1
-                t_per_c = len(city.owner.troops) / len(
+                owner_idx = self.players.index(city.owner)
+                t_per_c = self.troops.count_owned(owner_idx) / len(
                     [c for c in self.cities if c.owner == city.owner]
                 )
                 if city.timer >= 45 * (30 * t_per_c) and t_per_c < 10:
-                    city.owner.troops.append(
-                        Troop(
-                            (
-                                cx + random.randrange(-6, 6),
-                                cy + random.randrange(-6, 6),
-                            ),
-                            city.owner,
-                            city.path.copy(),
-                        )
+                    self.add_troop(
+                        (
+                            cx + random.randrange(-6, 6),
+                            cy + random.randrange(-6, 6),
+                        ),
+                        owner_idx,
+                        city.path.copy(),
                     )
                     city.timer = 0
-
-
-class Troop:
-    def __init__(self, position, owner, path=None):
-        self.position = position
-        self.health = 100
-        self.path = path if path is not None else []
-        self.owner = owner
-        self.id = id(self)
+        if ownership_changed:
+            self.update_city_fields()
+
+
+@dataclass(frozen=True)
+class World:
+    # One finished tick, see Environment.publish().  Arrays are read-only copies and the
+    # path lists are never mutated after publishing.
+    tick: int
+    troop_ids: np.ndarray
+    troop_owners: np.ndarray
+    troop_positions: np.ndarray
+    troop_health: np.ndarray
+    troop_paths: dict
+    city_ids: np.ndarray
+    city_owners: np.ndarray
+    city_positions: np.ndarray
+    city_paths: dict
+    borders: np.ndarray
+    vision_sources: list | None
+
+
+class TroopTable:
+    # One row per troop; dead rows are swap-removed by compact() so [:count] is dense.
+    def __init__(self, capacity=256):
+        self.count = 0
+        self.slots = {}
+        self.position = np.zeros((capacity, 2))
+        self.health = np.zeros(capacity)
+        self.owner = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.id = np.zeros(capacity, dtype=np.int64)
+        self.paths = []
+
+    def __len__(self):
+        return self.count
+
+    def columns(self):
+        return ("position", "health", "owner", "alive", "id")
+
+    def grow(self):
+        capacity = 2 * len(self.health)
+        for name in self.columns():
+            old = getattr(self, name)
+            new = np.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+            new[: self.count] = old[: self.count]
+            setattr(self, name, new)
+
+    def add(self, tid, position, owner, path=None):
+        if self.count == len(self.health):
+            self.grow()
+        slot = self.count
+        self.position[slot] = position
+        self.health[slot] = 100
+        self.owner[slot] = owner
+        self.alive[slot] = True
+        self.id[slot] = tid
+        self.slots[tid] = slot
+        self.paths.append(path if path is not None else [])
+        self.count += 1
+        return slot
+
+    def remove(self, slot):
+        last = self.count - 1
+        del self.slots[int(self.id[slot])]
+        if slot != last:
+            self.slots[int(self.id[last])] = slot
+            for name in self.columns():
+                column = getattr(self, name)
+                column[slot] = column[last]
+            self.paths[slot] = self.paths[last]
+        self.paths.pop()
+        self.count = last
+
+    def compact(self):
+        # Highest slot first, so the row swapped in from the end is always alive.
+        for slot in reversed(np.flatnonzero(~self.alive[: self.count]).tolist()):
+            self.remove(slot)
+
+    def count_owned(self, owner):
+        return int(np.count_nonzero(self.owner[: self.count] == owner))
 
 
 class City:
@@ -625,7 +1091,7 @@ class City:
         self.position = position
         self.timer = 0
         self.owner = None
-        self.id = id(self)
+        self.id = None
         self.path = []
 
 
@@ -633,87 +1099,237 @@ class Player:
     def __init__(self, start_pos, color, environment):
         self.start_pos = start_pos
         self.color = color
-        self.troops = [Troop(self.start_pos, self)]
         self.border = MarchingSquares()
         self.vision = MarchingSquares()
-        self.vision.grid = [row[:] for row in environment.default_vision]
+        self.vision.set_grid(environment.default_vision)
+        self.vision_tick = 0
+
+
+class FixedTimestep:
+    def __init__(self, rate, max_catch_up=5, clock=time.perf_counter):
+        self.step = 1 / rate
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.last = None
+        self.accumulator = 0.0
+        self.ticks = 0
+        self.overruns = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+
+    def due(self):
+        # Number of steps to run now.  More than one means the previous steps overran;
+        # beyond max_catch_up the backlog is dropped rather than spiralling.
+        now = self.clock()
+        if self.last is None:
+            self.last = now
+        self.accumulator += now - self.last
+        self.last = now
+        steps = int(self.accumulator // self.step)
+        if steps > 1:
+            self.overruns += 1
+            self.max_lag = max(self.max_lag, self.accumulator - self.step)
+        if steps > self.max_catch_up:
+            self.dropped += steps - self.max_catch_up
+            self.accumulator -= (steps - self.max_catch_up) * self.step
+            steps = self.max_catch_up
+        self.accumulator -= steps * self.step
+        self.ticks += steps
+        return steps
+
+    def time_to_next(self):
+        if self.last is None:
+            return 0.0
+        return max(0.0, self.step - self.accumulator - (self.clock() - self.last))
+
+    def report(self):
+        return (
+            f"ticks: {self.ticks}, overruns: {self.overruns}, dropped: {self.dropped},"
+            f" max lag: {self.max_lag * 1000:.1f} ms"
+        )
+
+
+class SnapshotCache:
+    # Views of the current tick, built and encoded once per player however many
+    # connections show that player.  Everything from earlier ticks is dropped.
+    def __init__(self, environment, grid_bits=wire.GRID_BITS):
+        self.environment = environment
+        self.grid_bits = grid_bits
+        self.tick = None
+        self.snapshots = {}
+        self.messages = {}
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        world = self.environment.world
+        if self.tick != world.tick:
+            self.tick = world.tick
+            self.snapshots.clear()
+            self.messages.clear()
+        return world
+
+    def snapshot(self, player):
+        world = self.current()
+        snap = self.snapshots.get(player)
+        if snap is None:
+            snap = self.environment.snapshot(player, self.grid_bits, world)
+            self.snapshots[player] = snap
+        return snap
+
+    def message(self, version, player, base):
+        # (message, snapshot the client will have once it applies it).  A delta against
+        # base when there is one, otherwise the full snapshot.  Deltas only carry exact
+        # changes, so every client that has base's tick gets the same one.
+        with self.lock:
+            snap = self.snapshot(player)
+            key = (version, player, None if base is None else base.tick)
+            cached = self.messages.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            if base is None:
+                cached = wire.encode_snapshot(version, snap), snap
+            else:
+                delta = wire.make_delta(base, snap)
+                cached = wire.encode_delta(version, delta), wire.apply_delta(base, delta)
+            self.messages[key] = cached
+            return cached
 
 
 class Game:
-    def __init__(self):
-        self.FPS = 45
-        self.last_time = time.perf_counter()
-        self.frame_time = 1 / self.FPS
+    def __init__(self, tick_rate=45, snapshot_rate=15, parallel=False, grid_bits=wire.GRID_BITS):
+        self.tick_rate = tick_rate
+        self.snapshot_rate = snapshot_rate
+        self.scheduler = FixedTimestep(tick_rate)
         self.done = False
-        self.server = simple_socket.Server(socket.gethostbyname(str(socket.gethostname())), 1200)
-        self.environment = Environment()
+        self.ip = socket.gethostbyname(str(socket.gethostname()))
+        self.port = PORTS[0]
+        self.environment = Environment(parallel=parallel)
+        self.snapshot_cache = SnapshotCache(self.environment, grid_bits)
         self.player_inputs = [[] for i in range(PLAYERS)]
         self.player_city_inputs = [[] for i in range(PLAYERS)]
         self.player_pause_requests = [False for i in range(PLAYERS)]
-        self.started = False
+        self.connections = 0
+        self.open_connections = set()
+        self.handlers = set()
+        self.started = asyncio.Event()
 
     def run_game(self):
-        self.ready = True
         try:
             port = int(input("Enter port to use (0 - 99): "))
-            self.server.port = PORTS[max(0, min(99, port))]
+            self.port = PORTS[max(0, min(99, port))]
         except ValueError:
             pass
-        print("ip: ", self.server.ip, ", port: ", self.server.port)
+        print("ip: ", self.ip, ", port: ", self.port)
+        asyncio.run(self.serve())
+        print(self.scheduler.report())
+        cache = self.snapshot_cache
+        print(f"snapshot cache: {cache.hits} hits, {cache.misses} misses")
+        self.environment.close()
+
+    async def serve(self):
+        # One event loop for everything: a task per connection plus the simulation task.
         print("starting server...")
-        self.server.start()
+        server = await asyncio.start_server(self.handle_connection, self.ip, self.port)
+        self.port = server.sockets[0].getsockname()[1]  # the one picked, for port 0
         print("waiting for players...")
-        self.server.lsn(conns=PLAYERS)
-        for player_num in range(PLAYERS):
-            conn, addr = self.server.accept()
-            player_thread = threading.Thread(
-                target=self.handle_player, args=(player_num, conn, addr)
-            )
-            player_thread.start()
-            print("player: ", player_num, " connected")
-        print("All players connected, starting game!")
-        self.started = True
+        async with server:
+            await self.started.wait()
+            print("All players connected, starting game!")
+            await self.simulate()
+            for conn in list(self.open_connections):
+                await conn.close()
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    async def simulate(self):
+        reported_overruns, last_report = 0, time.perf_counter()
         while not self.done:
-            if not all(self.player_pause_requests):
-                self.game_logic()
-            current_time = time.perf_counter()
-            delta_time = current_time - self.last_time
-            self.last_time = current_time
-            if delta_time < self.frame_time:
-                time.sleep(self.frame_time - delta_time)
-            # elif delta_time < self.frame_time*0.75:
-            #     self.dots = len(self.environment.players[0].troops)
-            #     print(self.dots)
-
-    def handle_player(self, player_number, conn, addr):
-        self.server.send(
-            [conn],
-            json.dumps(
-                (
-                    *self.environment.get_terrain_info(),
-                    player_number,
-                ),
-                separators=(",", ":"),
-            ),
+            for _ in range(self.scheduler.due()):
+                if not all(self.player_pause_requests):
+                    # Ticks run off the event loop; connections keep sending the last
+                    # published World meanwhile.
+                    await asyncio.to_thread(self.advance, *self.take_orders())
+            now = time.perf_counter()
+            if self.scheduler.overruns > reported_overruns and now - last_report >= 10:
+                reported_overruns, last_report = self.scheduler.overruns, now
+                print("server can't keep up,", self.scheduler.report())
+            await asyncio.sleep(self.scheduler.time_to_next())
+
+    async def handle_connection(self, reader, writer):
+        # The first PLAYERS connections are players; later ones spectate a player's view
+        # and their orders, pause requests and disconnects only affect themselves.
+        conn = simple_socket.AsyncConnection(reader, writer)
+        version = wire.negotiate(await conn.rcv())
+        if version is None:
+            await conn.send(wire.encode_reject())
+            await conn.close()
+            return
+        self.open_connections.add(conn)
+        handler = asyncio.current_task()
+        if handler is not None:
+            self.handlers.add(handler)
+            handler.add_done_callback(self.handlers.discard)
+        number = self.connections
+        self.connections += 1
+        player_number = number % PLAYERS
+        spectator = number >= PLAYERS
+        await conn.send(
+            wire.encode_welcome(
+                version, player_number, PLAYERS, *self.environment.get_terrain_info()
+            )
         )
-        while not self.started:
-            time.sleep(0.1)
-        draw_info = json.dumps([[], [], [], []], separators=(",", ":"))
-        while True:
-            if self.ready:
-                draw_info = json.dumps(
-                    self.environment.draw_info(player_number), separators=(",", ":")
+        if spectator:
+            print("spectator of player: ", player_number, " connected")
+        else:
+            print("player: ", player_number, " connected")
+            if self.connections == PLAYERS:
+                self.started.set()
+        await self.started.wait()
+        history, acked = wire.History(), None
+
+        async def push_snapshots():
+            # Snapshots go out on the server's schedule, against whatever the client last acked.
+            # They are built in a worker thread, since stamping vision can take a while.
+            snapshots = FixedTimestep(self.snapshot_rate, max_catch_up=1)
+            keyframe = None
+            while not self.done:
+                while not snapshots.due():
+                    await asyncio.sleep(snapshots.time_to_next())
+                message, keyframe = await asyncio.to_thread(
+                    self.view_message, version, player_number, history, acked, keyframe
                 )
-                self.server.send([conn], draw_info)
-            else:
-                self.server.send([conn], draw_info)
-            player_in = json.loads(self.server.rcv(conn))
+                try:
+                    await conn.send(message)
+                except ConnectionError:
+                    return
+
+        def pusher_done(task):
+            # Snapshots only stop by themselves once the client has gone.  Anything else is
+            # reported and hangs up, which ends the receive loop below as well.
+            if not task.cancelled() and task.exception() is not None:
+                print("snapshots to player: ", player_number, " failed: ", repr(task.exception()))
+                conn.writer.close()
+
+        pusher = asyncio.create_task(push_snapshots())
+        pusher.add_done_callback(pusher_done)
+        while True:
+            # Clients send orders and commands when they happen and a heartbeat otherwise.
+            try:
+                data = await asyncio.wait_for(conn.rcv(), INPUT_TIMEOUT)
+                acked, player_in = wire.decode_input(data)
+            except (wire.ProtocolError, TimeoutError):
+                player_in = "close"
             if player_in == "close" or self.done:
-                self.done = True
-                self.server.close(conn)
-                print("player: ", player_number, " left")
+                pusher.cancel()
+                if not spectator:
+                    self.done = True
+                self.open_connections.discard(conn)
+                await conn.close()
+                print("spectator of player: " if spectator else "player: ", player_number, " left")
                 break
-            if player_in:
+            if player_in and not spectator:
                 if player_in == "pause":
                     self.player_pause_requests[player_number] = True
                 elif player_in == "unpause":
@@ -722,25 +1338,43 @@ class Game:
                     self.player_inputs[player_number].extend(player_in[0])
                     self.player_city_inputs[player_number].extend(player_in[1])
 
-    def game_logic(self):
+    def view_message(self, version, player, history, acked, keyframe):
+        # keyframe is the tick of the last full snapshot sent on this connection; the next
+        # one goes out once the current KEYFRAME_TICKS window has none, whatever was acked.
+        if acked is not None:
+            history.discard_before(acked)
+        base = history.get(acked)
+        tick = self.environment.world.tick
+        if keyframe is None or keyframe // KEYFRAME_TICKS != tick // KEYFRAME_TICKS:
+            base = None
+        message, snap = self.snapshot_cache.message(version, player, base)
+        history.add(snap)
+        return message, snap.tick if base is None else keyframe
+
+    def take_orders(self):
         city_paths_to_apply = []
         for p_num in range(PLAYERS):
             if self.player_city_inputs[p_num]:
                 city_paths_to_apply.extend(self.player_city_inputs[p_num])
         self.player_city_inputs = [[] for i in range(PLAYERS)]
-        self.environment.update_cities(city_paths_to_apply)
         paths_to_apply = []
         for p_num in range(PLAYERS):
             if self.player_inputs[p_num]:
                 paths_to_apply.extend(self.player_inputs[p_num])
         self.player_inputs = [[] for i in range(PLAYERS)]
-        self.ready = False
+        return city_paths_to_apply, paths_to_apply
+
+    def advance(self, city_paths_to_apply, paths_to_apply):
+        self.environment.update_cities(city_paths_to_apply)
         self.environment.update_troops(paths_to_apply)
-        self.ready = True
+
+    def game_logic(self):
+        self.advance(*self.take_orders())
 
 
 def main() -> None:
-    game_play = Game()
+    # Per-player fields only pay for worker processes once there are enough players.
+    game_play = Game(parallel=PLAYERS >= 4 and (os.cpu_count() or 1) > 1)
     game_play.run_game()
 
 